@@ -1,13 +1,29 @@
 import os
+import sys
 import time
 import json
 import requests
+import asyncio
 import threading
 import schedule
 import re
+import random
+import unicodedata
 import tempfile
+import sqlite3
+import copy
+import functools
+import inspect
+import hmac
+import hashlib
 from datetime import datetime, timedelta
 from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode, parse_qs, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import telebot
 import anthropic
 from openai import OpenAI
@@ -19,6 +35,9 @@ TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "")
 MY_CHAT_ID = int(os.environ.get("MY_CHAT_ID", "0"))
 META_AD_ACCOUNT = os.environ.get("META_AD_ACCOUNT", "")
 META_ACCESS_TOKEN = os.environ.get("META_ACCESS_TOKEN", "")
+META_GRAPH_URL = os.environ.get("META_GRAPH_URL", "https://graph.facebook.com/v21.0")
+META_TIMEOUT = int(os.environ.get("META_TIMEOUT", "30"))
+META_MAX_CONCURRENCY = int(os.environ.get("META_MAX_CONCURRENCY", "6"))
 ANTHROPIC_KEY = os.environ.get("ANTHROPIC_KEY", "")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
 
@@ -28,9 +47,17 @@ AMOCRM_TOKEN = os.environ.get("AMOCRM_TOKEN", "")
 
 # Wazzup24 config (for WhatsApp/Instagram chat history)
 WAZZUP_API_KEY = os.environ.get("WAZZUP_API_KEY", "")
+WAZZUP_API_URL = "https://api.wazzup24.com/v3"
+WAZZUP_TIMEOUT = 15
+WAZZUP_MAX_CONCURRENCY = 8
+WAZZUP_CHANNELS_TTL = 3600
 
 ISRAEL_UTC_OFFSET = 2
 
+# Local SQLite store (Meta insights, etc.) — survives restarts if DATA_DIR is a volume
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
+LOCAL_DB_PATH = os.environ.get("LOCAL_DB_PATH", os.path.join(DATA_DIR, "ads_agent.db"))
+
 bot = telebot.TeleBot(TELEGRAM_TOKEN)
 claude = anthropic.Anthropic(api_key=ANTHROPIC_KEY)
 openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
@@ -175,89 +202,1010 @@ def parse_custom_period(text):
 
     return None, None
 
+def iter_days(since, until):
+    """All dates from since to until inclusive, as YYYY-MM-DD strings."""
+    day = datetime.strptime(since, "%Y-%m-%d").date()
+    last = datetime.strptime(until, "%Y-%m-%d").date()
+    days = []
+    while day <= last:
+        days.append(str(day))
+        day += timedelta(days=1)
+    return days
+
+def group_day_ranges(days):
+    """Collapse a list of YYYY-MM-DD strings into contiguous (since, until) ranges."""
+    ranges = []
+    for d in sorted(days):
+        if ranges:
+            prev_until = datetime.strptime(ranges[-1][1], "%Y-%m-%d").date()
+            if str(prev_until + timedelta(days=1)) == d:
+                ranges[-1][1] = d
+                continue
+        ranges.append([d, d])
+    return [tuple(r) for r in ranges]
+
 # ============================================================
-# META ADS API
+# LOCAL STORE (SQLite)
+# ============================================================
+_DB_SCHEMA = [
+    # One row per (day, campaign) — filled from /insights with time_increment=1
+    """CREATE TABLE IF NOT EXISTS meta_insights_daily (
+        day TEXT NOT NULL,
+        campaign_id TEXT NOT NULL,
+        campaign_name TEXT,
+        spend REAL DEFAULT 0,
+        impressions INTEGER DEFAULT 0,
+        clicks INTEGER DEFAULT 0,
+        actions TEXT,
+        PRIMARY KEY (day, campaign_id)
+    )""",
+    # Days already pulled from Meta (a day with no spend has no rows above, but is still synced)
+    """CREATE TABLE IF NOT EXISTS meta_insights_days (
+        day TEXT PRIMARY KEY,
+        synced_at INTEGER NOT NULL,
+        synced_on TEXT NOT NULL
+    )""",
+    # Meta lead archive — attribution fields only, no field_data
+    """CREATE TABLE IF NOT EXISTS meta_leads (
+        id TEXT PRIMARY KEY,
+        form_id TEXT,
+        form_name TEXT,
+        created_time TEXT,
+        created_ts INTEGER,
+        ad_id TEXT,
+        ad_name TEXT,
+        campaign_id TEXT,
+        campaign_name TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS meta_leads_created ON meta_leads (created_ts)",
+    """CREATE TABLE IF NOT EXISTS meta_lead_forms (
+        form_id TEXT PRIMARY KEY,
+        form_name TEXT,
+        watermark_ts INTEGER DEFAULT 0,
+        synced_at INTEGER DEFAULT 0
+    )""",
+    # amoCRM deal (lead) mirror — tags and contact links as JSON lists
+    """CREATE TABLE IF NOT EXISTS amocrm_deals (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        price INTEGER DEFAULT 0,
+        pipeline_id INTEGER,
+        status_id INTEGER,
+        created_at INTEGER DEFAULT 0,
+        closed_at INTEGER DEFAULT 0,
+        updated_at INTEGER DEFAULT 0,
+        tags TEXT,
+        contact_ids TEXT,
+        is_deleted INTEGER DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS amocrm_deals_created ON amocrm_deals (created_at)",
+    # Rollup dimensions of each live mirrored deal ('' = no fb/campaign tag, no close date)
+    """CREATE TABLE IF NOT EXISTS crm_deal_facts (
+        deal_id INTEGER PRIMARY KEY,
+        created_day TEXT,
+        closed_day TEXT,
+        pipeline_id INTEGER,
+        status_id INTEGER,
+        branch TEXT,
+        fb_tag TEXT,
+        campaign_tag TEXT,
+        price INTEGER DEFAULT 0
+    )""",
+    """CREATE INDEX IF NOT EXISTS crm_deal_facts_cell ON crm_deal_facts
+        (created_day, closed_day, pipeline_id, status_id, branch, fb_tag, campaign_tag)""",
+    # Daily CRM rollup — crm_deal_facts summed per cell; a period is a SUM over created_day
+    """CREATE TABLE IF NOT EXISTS crm_daily_rollup (
+        created_day TEXT,
+        closed_day TEXT,
+        pipeline_id INTEGER,
+        status_id INTEGER,
+        branch TEXT,
+        fb_tag TEXT,
+        campaign_tag TEXT,
+        deals INTEGER DEFAULT 0,
+        price_sum INTEGER DEFAULT 0,
+        priced INTEGER DEFAULT 0,
+        min_price INTEGER,
+        max_price INTEGER,
+        PRIMARY KEY (created_day, closed_day, pipeline_id, status_id, branch, fb_tag, campaign_tag)
+    )""",
+    # Contact ↔ deal links of live mirrored deals (which contacts a changed deal touches)
+    """CREATE TABLE IF NOT EXISTS crm_contact_deals (
+        contact_id INTEGER,
+        deal_id INTEGER,
+        PRIMARY KEY (contact_id, deal_id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS crm_contact_deals_deal ON crm_contact_deals (deal_id)",
+    # Per-contact deal aggregates, split by (branch, created day) so any period and branch filter
+    # can be summed; statuses is {status_id: count}, the rest are JSON lists
+    """CREATE TABLE IF NOT EXISTS crm_contact_ltv (
+        contact_id INTEGER,
+        branch TEXT,
+        created_day TEXT,
+        deals INTEGER DEFAULT 0,
+        total_spent INTEGER DEFAULT 0,
+        first_deal INTEGER DEFAULT 0,
+        last_deal INTEGER DEFAULT 0,
+        statuses TEXT,
+        campaigns TEXT,
+        fb_tags TEXT,
+        names TEXT,
+        PRIMARY KEY (contact_id, branch, created_day)
+    )""",
+    # amoCRM contacts — custom_fields in the v4 custom_fields_values shape
+    """CREATE TABLE IF NOT EXISTS amocrm_contacts (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        custom_fields TEXT,
+        lead_ids TEXT,
+        updated_at INTEGER DEFAULT 0,
+        is_deleted INTEGER DEFAULT 0
+    )""",
+    # Normalized (E.164) phone → contact id, built from amocrm_contacts
+    """CREATE TABLE IF NOT EXISTS amocrm_contact_phones (
+        phone TEXT,
+        contact_id INTEGER,
+        PRIMARY KEY (phone, contact_id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS amocrm_contact_phones_contact ON amocrm_contact_phones (contact_id)",
+    # Raw amoCRM notes per lead/contact, kept so repeat profiles only fetch new ones
+    """CREATE TABLE IF NOT EXISTS amocrm_notes (
+        id INTEGER PRIMARY KEY,
+        entity TEXT,
+        entity_id INTEGER,
+        note_type TEXT,
+        params TEXT,
+        created_at INTEGER DEFAULT 0,
+        updated_at INTEGER DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS amocrm_notes_entity ON amocrm_notes (entity, entity_id, created_at)",
+    """CREATE TABLE IF NOT EXISTS amocrm_note_streams (
+        entity TEXT,
+        entity_id INTEGER,
+        watermark_ts INTEGER DEFAULT 0,
+        synced_at INTEGER DEFAULT 0,
+        PRIMARY KEY (entity, entity_id)
+    )""",
+    # Wazzup chat history by chatId (international digits)
+    """CREATE TABLE IF NOT EXISTS wazzup_messages (
+        message_key TEXT PRIMARY KEY,
+        chat_id TEXT,
+        channel TEXT,
+        direction TEXT,
+        text TEXT,
+        ts INTEGER DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS wazzup_messages_chat ON wazzup_messages (chat_id, ts)",
+    # Webhook events already applied (amoCRM re-delivers on timeouts)
+    """CREATE TABLE IF NOT EXISTS amocrm_webhook_log (
+        event_key TEXT PRIMARY KEY,
+        entity TEXT,
+        action TEXT,
+        entity_id INTEGER,
+        received_at INTEGER
+    )""",
+    # Watermarks and other small sync bookkeeping
+    """CREATE TABLE IF NOT EXISTS sync_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+]
+
+_db_conn = None
+_db_lock = threading.RLock()
+
+def get_db():
+    """Shared SQLite connection (one per process, guarded by _db_lock)."""
+    global _db_conn
+    with _db_lock:
+        if _db_conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(LOCAL_DB_PATH)), exist_ok=True)
+            conn = sqlite3.connect(LOCAL_DB_PATH, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            for ddl in _DB_SCHEMA:
+                conn.execute(ddl)
+            conn.commit()
+            _db_conn = conn
+        return _db_conn
+
+def db_query(sql, params=()):
+    with _db_lock:
+        return get_db().execute(sql, params).fetchall()
+
+def db_execute(sql, params=()):
+    with _db_lock:
+        conn = get_db()
+        conn.execute(sql, params)
+        conn.commit()
+
+def db_executemany(sql, rows):
+    with _db_lock:
+        conn = get_db()
+        conn.executemany(sql, rows)
+        conn.commit()
+
+# ============================================================
+# REQUEST CONTEXT — one user question loads each dataset once
+# ============================================================
+_request_local = threading.local()
+
+@contextmanager
+def request_scope():
+    """
+    Memo for @request_cached functions, alive for one handler invocation.
+    Nested scopes reuse the outer one; threads join it via in_request_scope.
+    """
+    if getattr(_request_local, "memo", None) is not None:
+        yield
+        return
+    _request_local.memo = {"values": {}, "inflight": {}, "lock": threading.Lock()}
+    try:
+        yield
+    finally:
+        _request_local.memo = None
+
+def request_scoped(handler):
+    """Run a bot handler inside its own request_scope."""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        with request_scope():
+            return handler(*args, **kwargs)
+    return wrapper
+
+def in_request_scope(fn):
+    """Bind fn to the caller's request memo, for running it on another thread."""
+    memo = getattr(_request_local, "memo", None)
+    if memo is None:
+        return fn
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        previous = getattr(_request_local, "memo", None)
+        _request_local.memo = memo
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _request_local.memo = previous
+    return run
+
+def request_cached(fn):
+    """
+    Memoize fn by its bound arguments inside a request_scope (no-op outside one).
+    Concurrent callers of the same key wait for the first instead of recomputing;
+    every caller gets a shallow copy: setting or popping top-level keys is safe,
+    nested lists and dicts are shared and must be treated as read-only (copy
+    them first to change them). Exceptions, None and {"error": …} results are
+    not cached.
+    """
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        memo = getattr(_request_local, "memo", None)
+        if memo is None:
+            return fn(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (fn.__name__, tuple(bound.arguments.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return fn(*args, **kwargs)
+        with memo["lock"]:
+            if key in memo["values"]:
+                return copy.copy(memo["values"][key])
+            pending = memo["inflight"].get(key)
+            if pending is None:
+                memo["inflight"][key] = threading.Event()
+        if pending is not None:
+            pending.wait()
+            with memo["lock"]:
+                if key in memo["values"]:
+                    return copy.copy(memo["values"][key])
+            return fn(*args, **kwargs)   # the first caller failed or got nothing cacheable — try on our own
+        try:
+            value = fn(*args, **kwargs)
+            if value is not None and not (isinstance(value, dict) and "error" in value):
+                with memo["lock"]:
+                    memo["values"][key] = value
+        finally:
+            with memo["lock"]:
+                memo["inflight"].pop(key).set()
+        return copy.copy(value)
+    return wrapper
+
+# ============================================================
+# META GRAPH CLIENT — pooled keep-alive session, timeouts, bounded concurrency
 # ============================================================
-def get_all_campaigns(fields="name,status,effective_status"):
-    all_campaigns = []
-    url = f"https://graph.facebook.com/v21.0/{META_AD_ACCOUNT}/campaigns"
-    params = {"fields": fields, "limit": 500, "access_token": META_ACCESS_TOKEN}
+_meta_session = requests.Session()
+_meta_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=META_MAX_CONCURRENCY * 2,
+    # Connection-level hiccups only; API errors are returned to the caller
+    max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.5),
+))
+# Caps in-flight Graph requests across all threads (handlers, dashboard workers, scheduler)
+_meta_semaphore = threading.BoundedSemaphore(META_MAX_CONCURRENCY)
+
+# ============================================================
+# META THROTTLING — pace by usage headers, retry throttled calls
+# ============================================================
+# Graph error codes meaning "slow down" (app, user, page, ads-api and business-use-case limits)
+META_THROTTLE_CODES = {4, 17, 32, 613, 80000, 80001, 80002, 80003, 80004, 80005, 80006, 80008, 80009, 80014}
+META_TRANSIENT_CODES = {1, 2}   # "unknown" / "temporarily unavailable"
+META_MAX_RETRIES = int(os.environ.get("META_MAX_RETRIES", "4"))
+META_USAGE_SLOWDOWN_PCT = 75    # above this usage, calls are spaced out
+META_MAX_BACKOFF = 60           # never sleep longer than this per attempt (seconds)
+META_USAGE_HEADERS = ("X-App-Usage", "X-Ad-Account-Usage", "X-Business-Use-Case-Usage")
+
+_meta_usage = {"pct": 0.0, "regain_at": 0.0}
+_meta_usage_lock = threading.Lock()
+
+def _meta_record_usage(headers):
+    """Remember the highest usage % and any "come back in N minutes" hint Meta sent."""
+    pct, regain, seen = 0.0, 0.0, False
+    for name in META_USAGE_HEADERS:
+        raw = headers.get(name)
+        if not raw:
+            continue
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            continue
+        seen = True
+        if name == "X-Business-Use-Case-Usage":
+            entries = [e for items in value.values() for e in (items or [])]
+        else:
+            entries = [value]
+        for e in entries:
+            for key in ("call_count", "total_cputime", "total_time", "acc_id_util_pct"):
+                pct = max(pct, float(e.get(key, 0) or 0))
+            regain = max(regain, float(e.get("estimated_time_to_regain_access", 0) or 0) * 60)
+            if float(e.get("acc_id_util_pct", 0) or 0) >= 100:
+                regain = max(regain, float(e.get("reset_time_duration", 0) or 0))
+    if not seen:
+        return
+    with _meta_usage_lock:
+        _meta_usage["pct"] = pct
+        if regain:
+            _meta_usage["regain_at"] = max(_meta_usage["regain_at"], time.time() + regain)
+
+def _meta_pace():
+    """Sleep before a call when the last response said we are close to (or over) the limit."""
+    with _meta_usage_lock:
+        pct, regain_at = _meta_usage["pct"], _meta_usage["regain_at"]
+    now = time.time()
+    if regain_at > now:
+        wait = regain_at - now
+    elif pct >= META_USAGE_SLOWDOWN_PCT:
+        # 0 s at 75% usage → 5 s at 100%
+        wait = (min(pct, 100) - META_USAGE_SLOWDOWN_PCT) / (100 - META_USAGE_SLOWDOWN_PCT) * 5
+    else:
+        return
+    wait = min(wait, META_MAX_BACKOFF)
+    print(f"Meta usage {pct:.0f}% — pacing {wait:.1f}s")
+    time.sleep(wait)
+
+def _meta_should_retry(status, data):
+    """
+    A Graph error object decides on its own (code / is_transient) — permanent
+    errors such as 100 or 190 can come with a 500. The HTTP status only
+    counts when there is no error body (data is None for a non-JSON body).
+    """
+    err = data.get("error") if isinstance(data, dict) else None
+    if isinstance(err, dict):
+        return err.get("code") in META_THROTTLE_CODES or err.get("code") in META_TRANSIENT_CODES or bool(err.get("is_transient"))
+    return status == 429 or status >= 500
+
+def _meta_http(method, url, params=None, data=None, timeout=META_TIMEOUT):
+    """
+    One pooled HTTP call to Graph, paced by usage headers and retried with
+    backoff when throttled. Always returns parsed JSON; failures come back as
+    {"error": {...}} — with "throttled": True if retries ran out.
+    """
+    result = None
+    for attempt in range(META_MAX_RETRIES + 1):
+        _meta_pace()
+        try:
+            with _meta_semaphore:
+                resp = _meta_session.request(method, url, params=params, data=data, timeout=timeout)
+        except requests.RequestException as e:
+            result, status = {"error": {"message": str(e), "code": "network"}}, 0
+        else:
+            _meta_record_usage(resp.headers)
+            status = resp.status_code
+            try:
+                result = resp.json()
+            except ValueError:
+                result = None
+            retry = _meta_should_retry(status, result)
+            if result is None:
+                result = {"error": {"message": f"HTTP {status}: {resp.text[:150]}", "code": status}}
+            if not retry:
+                return result
+        if attempt == META_MAX_RETRIES:
+            break
+        with _meta_usage_lock:
+            regain_wait = _meta_usage["regain_at"] - time.time()
+        wait = max(min(META_MAX_BACKOFF, 2 ** attempt * 2) + random.uniform(0, 1), regain_wait)
+        print(f"Meta throttled/unavailable (HTTP {status}), retry {attempt + 1}/{META_MAX_RETRIES} in {min(wait, META_MAX_BACKOFF):.1f}s")
+        time.sleep(min(wait, META_MAX_BACKOFF))
+    if isinstance(result, dict) and "error" in result:
+        result["error"]["throttled"] = True
+    return result
+
+def meta_get(path, params=None, timeout=META_TIMEOUT):
+    """
+    GET a Graph API object or edge. `path` is relative to META_GRAPH_URL
+    (e.g. "act_123/insights") or a full paging.next URL.
+    Always returns a dict; transport errors come back as {"error": {...}}.
+    """
+    if path.startswith("http"):
+        return _meta_http("GET", path, params or {}, timeout=timeout)
+    prefetched = _meta_prefetched_get(path, params)
+    if prefetched is not None:
+        return prefetched
+    return _meta_http("GET", f"{META_GRAPH_URL}/{path.lstrip('/')}",
+                      {**(params or {}), "access_token": META_ACCESS_TOKEN}, timeout=timeout)
+
+def meta_get_all(path, params=None, timeout=META_TIMEOUT):
+    """
+    Follow paging.next and collect every `data` row.
+    Returns (rows, error) — error is None when all pages came back.
+    """
+    rows = []
+    url, page_params = path, params
     while url:
-        resp = requests.get(url, params=params)
-        data = resp.json()
-        if "data" in data:
-            all_campaigns.extend(data["data"])
-        url = data.get("paging", {}).get("next", None)
-        params = {}
-    return all_campaigns
+        data = meta_get(url, page_params, timeout=timeout)
+        if "error" in data:
+            return rows, data["error"]
+        rows.extend(data.get("data", []))
+        url = data.get("paging", {}).get("next")
+        page_params = None
+    return rows, None
 
-def get_account_insights(since, until):
-    url = f"https://graph.facebook.com/v21.0/{META_AD_ACCOUNT}/insights"
-    params = {
-        "fields": "campaign_name,campaign_id,spend,impressions,clicks,ctr,cpc,cpm,actions,cost_per_action_type",
+def run_parallel(tasks, max_workers=META_MAX_CONCURRENCY):
+    """
+    Run independent callables concurrently: {"name": fn} -> {"name": result}.
+    Exceptions are re-raised from the caller's thread, like a plain call would.
+    """
+    if not tasks:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as ex:
+        futures = {name: ex.submit(in_request_scope(fn)) for name, fn in tasks.items()}
+        return {name: f.result() for name, f in futures.items()}
+
+def meta_get_many(calls, timeout=META_TIMEOUT):
+    """Fetch several paginated edges in parallel: [(path, params), ...] -> [(rows, error), ...]."""
+    with ThreadPoolExecutor(max_workers=max(1, min(META_MAX_CONCURRENCY, len(calls)))) as ex:
+        return list(ex.map(lambda c: meta_get_all(c[0], c[1], timeout=timeout), calls))
+
+# ============================================================
+# META BATCH — pack independent GETs into one POST /batch
+# ============================================================
+META_BATCH_MAX = 50          # Graph API hard limit per batch
+META_PREFETCH_TTL = 120      # seconds a batched response waits for its caller
+
+_meta_prefetch = {}          # (path, params) key -> (expires_at, response body)
+_meta_prefetch_lock = threading.Lock()
+
+def _meta_call_key(path, params):
+    return path.lstrip("/"), json.dumps(params or {}, sort_keys=True, default=str)
+
+def _meta_prefetched_get(path, params):
+    key = _meta_call_key(path, params)
+    with _meta_prefetch_lock:
+        hit = _meta_prefetch.get(key)
+        if hit and hit[0] > time.time():
+            return hit[1]
+        _meta_prefetch.pop(key, None)
+    return None
+
+def meta_batch(calls, timeout=META_TIMEOUT):
+    """
+    Send independent GETs as Graph batch requests (up to 50 per POST).
+    calls: [(path, params), ...] -> [response body, ...] in the same order.
+    Each body is what meta_get would have returned for that call's first page.
+    """
+    results = []
+    for i in range(0, len(calls), META_BATCH_MAX):
+        chunk = calls[i:i + META_BATCH_MAX]
+        batch = [
+            {"method": "GET", "relative_url": f"{path.lstrip('/')}?{urlencode(params or {})}"}
+            for path, params in chunk
+        ]
+        data = _meta_http("POST", f"{META_GRAPH_URL}/",
+                          data={"batch": json.dumps(batch), "include_headers": "false",
+                                "access_token": META_ACCESS_TOKEN},
+                          timeout=timeout)
+        if not isinstance(data, list):
+            err = data.get("error") if isinstance(data, dict) else None
+            results.extend({"error": err or {"message": "bad batch response"}} for _ in chunk)
+            continue
+        for item in data:
+            if not item:
+                # Graph returns null for calls it did not finish within the batch
+                results.append({"error": {"message": "batch item timed out", "code": "batch_timeout"}})
+                continue
+            try:
+                results.append(json.loads(item.get("body") or "{}"))
+            except ValueError:
+                results.append({"error": {"message": f"HTTP {item.get('code')}", "code": item.get("code")}})
+    return results
+
+def meta_prefetch(calls):
+    """
+    Run calls as one batch and park the successful first pages, so the regular
+    meta_get/meta_get_all callers pick them up instead of making their own round-trip.
+    """
+    unique = {}
+    for path, params in calls:
+        unique.setdefault(_meta_call_key(path, params), (path, params))
+    calls = list(unique.values())
+    if not calls:
+        return
+    try:
+        bodies = meta_batch(calls)
+    except Exception as e:
+        print(f"Meta batch error: {e}")
+        return
+    expires = time.time() + META_PREFETCH_TTL
+    with _meta_prefetch_lock:
+        for (path, params), body in zip(calls, bodies):
+            if isinstance(body, dict) and "error" not in body:
+                _meta_prefetch[_meta_call_key(path, params)] = (expires, body)
+    print(f"Meta batch: {len(calls)} calls in {(len(calls) - 1) // META_BATCH_MAX + 1} request(s)")
+
+# asyncio flavour of the same client — shares the session pool and the semaphore
+async def meta_get_async(path, params=None, timeout=META_TIMEOUT):
+    return await asyncio.to_thread(meta_get, path, params, timeout)
+
+async def meta_get_all_async(path, params=None, timeout=META_TIMEOUT):
+    return await asyncio.to_thread(meta_get_all, path, params, timeout)
+
+async def meta_get_many_async(calls, timeout=META_TIMEOUT):
+    return await asyncio.gather(*(meta_get_all_async(p, prm, timeout) for p, prm in calls))
+
+def get_sync_state(key, default=None):
+    rows = db_query("SELECT value FROM sync_state WHERE key = ?", (key,))
+    return rows[0]["value"] if rows else default
+
+def set_sync_state(key, value):
+    db_execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, str(value)))
+
+# ============================================================
+# META ADS API
+# ============================================================
+# ============================================================
+# META CAMPAIGN CATALOG — in-process, indexed by id and name, TTL refresh
+# ============================================================
+META_CAMPAIGN_CATALOG_TTL = int(os.environ.get("META_CAMPAIGN_CATALOG_TTL", "600"))
+CAMPAIGN_CATALOG_FIELDS = "id,name,status,effective_status"
+
+_campaign_catalog = {"campaigns": [], "by_id": {}, "by_name": {}, "loaded_at": 0}
+_campaign_catalog_lock = threading.Lock()
+
+def _campaign_catalog_call():
+    return f"{META_AD_ACCOUNT}/campaigns", {"fields": CAMPAIGN_CATALOG_FIELDS, "limit": 500}
+
+def get_campaign_catalog(force=False):
+    """
+    Campaign list kept in memory for META_CAMPAIGN_CATALOG_TTL seconds.
+    force=True re-reads it from Meta right away (e.g. after campaigns were edited).
+    """
+    with _campaign_catalog_lock:
+        if not force and time.time() - _campaign_catalog["loaded_at"] < META_CAMPAIGN_CATALOG_TTL:
+            return _campaign_catalog
+        campaigns, error = meta_get_all(*_campaign_catalog_call())
+        if error:
+            print(f"Meta campaigns error: {error.get('message', '')[:150]}")
+            if _campaign_catalog["loaded_at"] or not campaigns:
+                return _campaign_catalog  # keep the last complete list rather than a partial one
+        by_name = {}
+        for c in campaigns:
+            by_name.setdefault(c.get("name", ""), []).append(c)
+        _campaign_catalog.update({
+            "campaigns": campaigns,
+            "by_id": {c.get("id"): c for c in campaigns},
+            "by_name": by_name,
+            # A partial first load is served but retried on the next call
+            "loaded_at": 0 if error else time.time(),
+        })
+        return _campaign_catalog
+
+def refresh_campaign_catalog():
+    return get_campaign_catalog(force=True)
+
+def campaign_name_by_fb_tag(fb_tag):
+    """amoCRM fb-tag ("fb{campaign_id}") → Meta campaign name, or "" if unknown."""
+    if not fb_tag or not fb_tag.startswith("fb"):
+        return ""
+    return get_campaign_catalog()["by_id"].get(fb_tag[2:], {}).get("name", "")
+
+def campaign_status_summary():
+    campaigns = get_campaign_catalog()["campaigns"]
+    active = [c.get("name", "—") for c in campaigns if c.get("effective_status") == "ACTIVE"]
+    paused = sum(1 for c in campaigns if c.get("effective_status") == "PAUSED")
+    return {"total": len(campaigns), "active_names": active, "active_count": len(active), "paused_count": paused}
+
+def _daily_insights_call(since, until):
+    return f"{META_AD_ACCOUNT}/insights", {
+        "fields": "campaign_name,campaign_id,spend,impressions,clicks,actions",
         "time_range": json.dumps({"since": since, "until": until}),
+        "time_increment": 1,
         "level": "campaign",
         "limit": 500,
-        "access_token": META_ACCESS_TOKEN,
     }
-    all_insights = []
+
+@request_cached
+def fetch_daily_insights(since, until):
+    """Download per-day, per-campaign insight rows from Meta. Returns None on API error."""
+    rows, error = meta_get_all(*_daily_insights_call(since, until))
+    if error:
+        print(f"Meta insights error {since}..{until}: {error.get('message', '')[:150]}")
+        return None
+    return rows
+
+# ============================================================
+# META ASYNC INSIGHTS REPORTS — for long date ranges
+# ============================================================
+# Ranges longer than this go through an async report run instead of paging /insights
+META_ASYNC_INSIGHTS_MIN_DAYS = int(os.environ.get("META_ASYNC_INSIGHTS_MIN_DAYS", "60"))
+META_ASYNC_REPORT_TIMEOUT = 900   # seconds to wait for Meta to finish a report run
+META_ASYNC_POLL_MAX = 15          # longest pause between status polls (seconds)
+
+def use_async_insights(since, until):
+    days = (datetime.strptime(until, "%Y-%m-%d") - datetime.strptime(since, "%Y-%m-%d")).days + 1
+    return days > META_ASYNC_INSIGHTS_MIN_DAYS
+
+def iter_async_insights_report(path, params):
+    """
+    Submit `path` (an /insights edge) as an async report run, poll until Meta
+    finishes it, then yield the result one page of rows at a time.
+    Raises RuntimeError if the run fails, is skipped or times out.
+    """
+    job = _meta_http("POST", f"{META_GRAPH_URL}/{path}", data={**params, "access_token": META_ACCESS_TOKEN})
+    run_id = job.get("report_run_id") if isinstance(job, dict) else None
+    if not run_id:
+        raise RuntimeError(f"report run not created: {(job or {}).get('error', {}).get('message', job)}")
+
+    deadline = time.time() + META_ASYNC_REPORT_TIMEOUT
+    pause = 2
     while True:
-        resp = requests.get(url, params=params)
-        data = resp.json()
-        if "data" in data:
-            all_insights.extend(data["data"])
-        next_url = data.get("paging", {}).get("next", None)
-        if next_url:
-            url = next_url
-            params = {}
-        else:
+        status = meta_get(run_id, {"fields": "async_status,async_percent_completion"})
+        if "error" in status:
+            raise RuntimeError(f"report run {run_id} status error: {status['error'].get('message', '')[:150]}")
+        state = status.get("async_status")
+        if state == "Job Completed":
             break
-    return all_insights
+        if state in ("Job Failed", "Job Skipped"):
+            raise RuntimeError(f"report run {run_id}: {state}")
+        if time.time() > deadline:
+            raise RuntimeError(f"report run {run_id} not finished after {META_ASYNC_REPORT_TIMEOUT}s")
+        print(f"Meta report {run_id}: {state} {status.get('async_percent_completion', 0)}%")
+        time.sleep(pause)
+        pause = min(pause * 1.5, META_ASYNC_POLL_MAX)
+
+    url, page_params = f"{run_id}/insights", {"limit": 500}
+    while url:
+        data = meta_get(url, page_params)
+        if "error" in data:
+            raise RuntimeError(f"report run {run_id} page error: {data['error'].get('message', '')[:150]}")
+        yield data.get("data", [])
+        url = data.get("paging", {}).get("next")
+        page_params = None
 
-def get_meta_leads(since, until):
-    """Fetch leads from Meta Leads Center (forms)."""
-    all_leads = []
-    url = f"https://graph.facebook.com/v21.0/{META_AD_ACCOUNT}/leadgen_forms"
-    params = {"fields": "id,name,status", "access_token": META_ACCESS_TOKEN}
+# ============================================================
+# META INSIGHTS STORE — per-day rows in SQLite, incremental sync
+# ============================================================
+# Meta keeps attributing conversions to a day for a while after it ends,
+# so a day is only "final" once it was synced this many days later.
+META_INSIGHTS_REFETCH_DAYS = 3
+# Non-final days are re-pulled at most this often (seconds)
+META_INSIGHTS_REFRESH_TTL = 900
+
+_insights_sync_lock = threading.Lock()
+_insights_loading_days = set()   # days an async report run is fetching in the background
+
+def _insights_days_to_sync(since, until):
+    today = get_israel_now().date()
+    days = [d for d in iter_days(since, until) if d <= str(today)]
+    if not days:
+        return []
+    synced = {
+        r["day"]: r for r in db_query(
+            "SELECT day, synced_at, synced_on FROM meta_insights_days WHERE day BETWEEN ? AND ?",
+            (days[0], days[-1]))
+    }
+    now = int(time.time())
+    stale = []
+    for d in days:
+        row = synced.get(d)
+        if row is None:
+            stale.append(d)
+            continue
+        final_on = str(datetime.strptime(d, "%Y-%m-%d").date() + timedelta(days=META_INSIGHTS_REFETCH_DAYS))
+        if row["synced_on"] < final_on and now - row["synced_at"] > META_INSIGHTS_REFRESH_TTL:
+            stale.append(d)
+    return stale
+
+def _insert_daily_rows(conn, rows):
+    conn.executemany(
+        "INSERT OR REPLACE INTO meta_insights_daily "
+        "(day, campaign_id, campaign_name, spend, impressions, clicks, actions) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(
+            r.get("date_start"), r.get("campaign_id", ""), r.get("campaign_name", ""),
+            float(r.get("spend", 0) or 0), int(r.get("impressions", 0) or 0), int(r.get("clicks", 0) or 0),
+            json.dumps(r.get("actions", [])),
+        ) for r in rows if r.get("date_start")]
+    )
+
+def _mark_days_synced(conn, since, until):
+    now = int(time.time())
+    synced_on = str(get_israel_now().date())
+    conn.executemany(
+        "INSERT OR REPLACE INTO meta_insights_days (day, synced_at, synced_on) VALUES (?, ?, ?)",
+        [(d, now, synced_on) for d in iter_days(since, until)]
+    )
+
+def _store_daily_insights(since, until, rows):
+    with _db_lock:
+        conn = get_db()
+        conn.execute("DELETE FROM meta_insights_daily WHERE day BETWEEN ? AND ?", (since, until))
+        _insert_daily_rows(conn, rows)
+        _mark_days_synced(conn, since, until)
+        conn.commit()
+
+def _sync_insights_async(since, until):
+    """
+    Collect a whole async report run, then replace the range in one transaction —
+    a failed or timed-out run leaves the stored days untouched.
+    """
+    rows = []
+    for page in iter_async_insights_report(*_daily_insights_call(since, until)):
+        rows.extend(page)
+    _store_daily_insights(since, until, rows)
+    print(f"Meta async report {since} — {until}: {len(rows)} rows")
+
+def _sync_insights_background(since, until):
+    """Report-run worker: polling can take minutes, so it never holds _insights_sync_lock."""
     try:
-        resp = requests.get(url, params=params)
-        forms = resp.json().get("data", [])
+        try:
+            _sync_insights_async(since, until)
+            return
+        except RuntimeError as e:
+            # Fall back to plain paging; if that fails too, the days stay unsynced
+            print(f"Meta async report failed, paging /insights instead: {e}")
+        rows = fetch_daily_insights(since, until)
+        if rows is not None:
+            _store_daily_insights(since, until, rows)
     except Exception as e:
-        print(f"Meta forms error: {e}")
+        print(f"Meta insights background sync error: {e}")
+    finally:
+        with _insights_sync_lock:
+            _insights_loading_days.difference_update(iter_days(since, until))
+
+def sync_insights(since, until):
+    """
+    Pull only missing / not-yet-final days of [since, until] from Meta into the store.
+    The last META_ASYNC_INSIGHTS_MIN_DAYS days are always pulled right here; only
+    older history may go to a background report run, and until it lands those
+    days stay missing and meta_data_gaps reports them as still loading. A short
+    request fetches its days itself even if a report run is also loading them.
+    """
+    recent_from = str(get_israel_now().date() - timedelta(days=META_ASYNC_INSIGHTS_MIN_DAYS - 1))
+    short = not use_async_insights(since, until)
+    with _insights_sync_lock:
+        stale = [d for d in _insights_days_to_sync(since, until) if short or d not in _insights_loading_days]
+        if not stale:
+            return
+        ranges = (group_day_ranges([d for d in stale if d < recent_from]) +
+                  group_day_ranges([d for d in stale if d >= recent_from]))
+        for r_since, r_until in ranges:
+            print(f"Meta insights sync: {r_since} — {r_until}")
+            if use_async_insights(r_since, r_until):
+                _insights_loading_days.update(iter_days(r_since, r_until))
+                threading.Thread(target=_sync_insights_background, args=(r_since, r_until), daemon=True).start()
+                continue
+            rows = fetch_daily_insights(r_since, r_until)
+            if rows is None:
+                continue  # days stay unsynced, next call retries them
+            _store_daily_insights(r_since, r_until, rows)
+
+def meta_insights_missing_days(since, until):
+    """Days of [since, until] (up to today) that could not be pulled from Meta yet."""
+    days = [d for d in iter_days(since, until) if d <= str(get_israel_now().date())]
+    if not days:
         return []
+    synced = {r["day"] for r in db_query(
+        "SELECT day FROM meta_insights_days WHERE day BETWEEN ? AND ?", (days[0], days[-1]))}
+    return [d for d in days if d not in synced]
+
+@request_cached
+def get_account_insights(since, until):
+    """Campaign-level insights for [since, until], summed from the local per-day store."""
+    try:
+        sync_insights(since, until)
+    except Exception as e:
+        print(f"Meta insights sync error: {e}")
+
+    by_campaign = {}
+    for r in db_query(
+            "SELECT day, campaign_id, campaign_name, spend, impressions, clicks, actions "
+            "FROM meta_insights_daily WHERE day BETWEEN ? AND ? ORDER BY day", (since, until)):
+        c = by_campaign.setdefault(r["campaign_id"], {
+            "campaign_id": r["campaign_id"], "spend": 0.0, "impressions": 0, "clicks": 0, "actions": {},
+        })
+        c["campaign_name"] = r["campaign_name"]  # latest name wins (ORDER BY day)
+        c["spend"] += r["spend"] or 0
+        c["impressions"] += r["impressions"] or 0
+        c["clicks"] += r["clicks"] or 0
+        for a in json.loads(r["actions"] or "[]"):
+            atype = a.get("action_type", "")
+            c["actions"][atype] = c["actions"].get(atype, 0) + int(float(a.get("value", 0) or 0))
+
+    # Same shape as a Graph /insights row, so enrich_insights works unchanged
+    all_insights = []
+    for c in by_campaign.values():
+        spend, impressions, clicks = c["spend"], c["impressions"], c["clicks"]
+        all_insights.append({
+            "campaign_name": c["campaign_name"],
+            "campaign_id": c["campaign_id"],
+            "spend": round(spend, 2),
+            "impressions": impressions,
+            "clicks": clicks,
+            "ctr": round(clicks / impressions * 100, 4) if impressions else 0,
+            "cpc": round(spend / clicks, 4) if clicks else 0,
+            "cpm": round(spend / impressions * 1000, 4) if impressions else 0,
+            "actions": [{"action_type": t, "value": v} for t, v in c["actions"].items()],
+            "cost_per_action_type": [
+                {"action_type": t, "value": round(spend / v, 4)} for t, v in c["actions"].items() if v > 0
+            ],
+        })
+    return all_insights
+
+def _leadgen_forms_call():
+    return f"{META_AD_ACCOUNT}/leadgen_forms", {"fields": "id,name,status", "limit": 100}
+
+# ============================================================
+# META LEAD ARCHIVE — lead metadata by id, per-form created_time watermark
+# ============================================================
+# Only attribution fields are archived; field_data (names/phones) is never stored
+META_LEAD_FIELDS = "id,created_time,ad_id,ad_name,campaign_id,campaign_name"
+META_LEADS_SYNC_TTL = 300    # seconds between delta syncs
+
+_leads_sync_lock = threading.Lock()
+_leads_synced_at = 0
+_leads_failed_forms = set()   # forms whose last delta sync did not finish
+
+def _lead_ts(created_time):
+    try:
+        return int(datetime.strptime(created_time, "%Y-%m-%dT%H:%M:%S%z").timestamp())
+    except (TypeError, ValueError):
+        return 0
 
+def _lead_range_ts(since, until):
+    """Same day boundaries the Graph filtering used before: [since 00:00, until 24:00)."""
     since_ts = int(datetime.strptime(since, "%Y-%m-%d").timestamp())
     until_ts = int(datetime.strptime(until, "%Y-%m-%d").timestamp()) + 86400
+    return since_ts, until_ts
 
-    for form in forms:
-        form_id = form.get("id")
-        form_name = form.get("name", "")
-        leads_url = f"https://graph.facebook.com/v21.0/{form_id}/leads"
-        leads_params = {
-            "fields": "id,created_time,field_data,ad_id,ad_name,campaign_id,campaign_name",
-            "filtering": json.dumps([{"field": "time_created", "operator": "GREATER_THAN", "value": since_ts}]),
-            "limit": 500,
-            "access_token": META_ACCESS_TOKEN,
-        }
-        try:
-            while True:
-                resp = requests.get(leads_url, params=leads_params)
-                data = resp.json()
-                for lead in data.get("data", []):
-                    lead["form_name"] = form_name
-                    all_leads.append(lead)
-                next_url = data.get("paging", {}).get("next")
-                if next_url:
-                    leads_url = next_url
-                    leads_params = {}
-                else:
-                    break
-        except Exception as e:
-            print(f"Error fetching leads for form {form_name}: {e}")
-            continue
-        time.sleep(0.5)
+def sync_meta_leads(force=False):
+    """Fetch only leads created after each form's watermark into the local archive."""
+    global _leads_synced_at, _leads_failed_forms
+    with _leads_sync_lock:
+        if not force and time.time() - _leads_synced_at < META_LEADS_SYNC_TTL:
+            return
+        forms, error = meta_get_all(*_leadgen_forms_call())
+        if error:
+            print(f"Meta forms error: {error.get('message', '')[:150]}")
+        if not forms:
+            return
+        watermarks = {r["form_id"]: r["watermark_ts"] for r in db_query("SELECT form_id, watermark_ts FROM meta_lead_forms")}
+
+        calls = []
+        for form in forms:
+            wm = watermarks.get(form.get("id"), 0)
+            calls.append((f"{form.get('id')}/leads", {
+                "fields": META_LEAD_FIELDS,
+                # -1: leads created in the same second as the watermark are re-read, INSERT OR REPLACE dedupes
+                "filtering": json.dumps([{"field": "time_created", "operator": "GREATER_THAN", "value": max(wm - 1, 0)}]),
+                "limit": 500,
+            }))
+        results = meta_get_many(calls)
+
+        fresh = 0
+        failed_forms = set()
+        with _db_lock:
+            conn = get_db()
+            for form, (leads, error) in zip(forms, results):
+                form_id, form_name = form.get("id"), form.get("name", "")
+                if error:
+                    print(f"Error fetching leads for form {form_name}: {error.get('message', '')[:150]}")
+                    failed_forms.add(form_name or form_id)
+                wm = watermarks.get(form_id, 0)
+                rows = []
+                for lead in leads:
+                    ts = _lead_ts(lead.get("created_time"))
+                    rows.append((
+                        lead.get("id"), form_id, form_name, lead.get("created_time", ""), ts,
+                        lead.get("ad_id", ""), lead.get("ad_name", ""),
+                        lead.get("campaign_id", ""), lead.get("campaign_name", ""),
+                    ))
+                    wm = max(wm, ts)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO meta_leads (id, form_id, form_name, created_time, created_ts, "
+                    "ad_id, ad_name, campaign_id, campaign_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                fresh += len(rows)
+                # A failed page leaves the watermark where it was so the gap is re-read next time
+                conn.execute(
+                    "INSERT INTO meta_lead_forms (form_id, form_name, watermark_ts, synced_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(form_id) DO UPDATE SET form_name = excluded.form_name, "
+                    "watermark_ts = excluded.watermark_ts, synced_at = excluded.synced_at",
+                    (form_id, form_name, watermarks.get(form_id, 0) if error else wm, int(time.time())))
+            conn.commit()
+        _leads_failed_forms = failed_forms   # swapped whole: meta_data_gaps reads it without the lock
+        _leads_synced_at = time.time()
+        print(f"Meta leads sync: {len(forms)} forms, {fresh} new/updated leads")
+
+@request_cached
+def count_meta_leads(since, until):
+    """Lead counts for [since, until] without touching any lead payloads: {"total", "by_campaign"}."""
+    try:
+        sync_meta_leads()
+    except Exception as e:
+        print(f"Meta leads sync error: {e}")
+    since_ts, until_ts = _lead_range_ts(since, until)
+    by_campaign = {
+        r["campaign_name"] or "?": r["n"] for r in db_query(
+            "SELECT campaign_name, COUNT(*) AS n FROM meta_leads "
+            "WHERE created_ts >= ? AND created_ts < ? GROUP BY campaign_name",
+            (since_ts, until_ts))
+    }
+    return {"total": sum(by_campaign.values()), "by_campaign": by_campaign}
 
-    return all_leads
+def meta_data_gaps(since, until):
+    """
+    None when Meta data for [since, until] is complete, otherwise a dict that
+    reports can pass through so the answer says the numbers are partial.
+    """
+    missing = meta_insights_missing_days(since, until)
+    failed_forms = sorted(_leads_failed_forms)
+    if not missing and not failed_forms:
+        return None
+    gaps = {"note": "Часть данных Meta не загрузилась (лимиты или ошибки API) — цифры могут быть занижены"}
+    if any(d in _insights_loading_days for d in missing):
+        gaps["still_loading"] = True
+        gaps["note"] = "Отчёт Meta за длинный период ещё формируется — цифры пока неполные, повторите запрос через несколько минут"
+    if missing:
+        gaps["missing_days"] = len(missing)
+        gaps["missing_ranges"] = [f"{a} — {b}" if a != b else a for a, b in group_day_ranges(missing)][:10]
+    if failed_forms:
+        gaps["lead_forms_failed"] = failed_forms
+    return gaps
+
+def prefetch_meta(since, until, compare=False, campaigns=False):
+    """
+    Warm every independent Meta query a report is about to make with one
+    /batch POST: insights for not-yet-synced days (and the previous period
+    when compare=True), the lead-form list, and optionally the campaign list.
+    """
+    if not META_ACCESS_TOKEN:
+        return
+    ranges = [(since, until)]
+    if compare:
+        prev_since, prev_until = get_previous_period(since, until)
+        if prev_since:
+            ranges.append((prev_since, prev_until))
+    calls = [_leadgen_forms_call()]
+    for r_since, r_until in ranges:
+        for s_since, s_until in group_day_ranges(_insights_days_to_sync(r_since, r_until)):
+            if not use_async_insights(s_since, s_until):  # long ranges go through a report run
+                calls.append(_daily_insights_call(s_since, s_until))
+    if campaigns and time.time() - _campaign_catalog["loaded_at"] >= META_CAMPAIGN_CATALOG_TTL:
+        calls.append(_campaign_catalog_call())
+    meta_prefetch(calls)
 
 # ============================================================
 # EXTRACT ACTIONS — with deduplication
@@ -327,102 +1275,1185 @@ def enrich_insights(insights):
     enriched.sort(key=lambda x: x["spend"], reverse=True)
     return enriched
 
-# ============================================================
-# amoCRM API
-# ============================================================
-def amocrm_request(endpoint, params=None, method="GET"):
-    if not AMOCRM_TOKEN:
-        print("amoCRM token not configured")
-        return None
-    url = f"https://{AMOCRM_DOMAIN}/api/v4/{endpoint}"
-    headers = {"Authorization": f"Bearer {AMOCRM_TOKEN}"}
+# ============================================================
+# amoCRM API
+# ============================================================
+# ============================================================
+# amoCRM RATE LIMITER — one token bucket for every thread / coroutine
+# ============================================================
+# amoCRM allows ~7 requests/second per integration
+AMOCRM_RATE_PER_SEC = float(os.environ.get("AMOCRM_RATE_PER_SEC", "7"))
+AMOCRM_BURST = int(os.environ.get("AMOCRM_BURST", "7"))
+
+_amocrm_bucket = {"tokens": float(AMOCRM_BURST), "updated": time.monotonic()}
+_amocrm_bucket_lock = threading.Lock()
+_amocrm_limiter_stats = {
+    "acquired": 0, "waited": 0, "wait_total": 0.0, "wait_max": 0.0,
+    "queue_depth": 0, "queue_max": 0, "throttled": 0,
+}
+
+def _amocrm_reserve():
+    """
+    Take the next slot from the bucket and return how long to wait for it.
+    Tokens may go negative: each caller reserves a future slot, so waiters
+    are served in arrival order at exactly AMOCRM_RATE_PER_SEC.
+    """
+    with _amocrm_bucket_lock:
+        now = time.monotonic()
+        tokens = min(AMOCRM_BURST, _amocrm_bucket["tokens"] + (now - _amocrm_bucket["updated"]) * AMOCRM_RATE_PER_SEC)
+        tokens -= 1
+        _amocrm_bucket["tokens"], _amocrm_bucket["updated"] = tokens, now
+        wait = -tokens / AMOCRM_RATE_PER_SEC if tokens < 0 else 0.0
+        st = _amocrm_limiter_stats
+        st["acquired"] += 1
+        if wait > 0:
+            st["waited"] += 1
+            st["wait_total"] += wait
+            st["wait_max"] = max(st["wait_max"], wait)
+            st["queue_depth"] += 1
+            st["queue_max"] = max(st["queue_max"], st["queue_depth"])
+        return wait
+
+def _amocrm_dequeue():
+    with _amocrm_bucket_lock:
+        _amocrm_limiter_stats["queue_depth"] -= 1
+
+def amocrm_rate_acquire():
+    """Block the calling thread until it may send one amoCRM request."""
+    wait = _amocrm_reserve()
+    if wait > 0:
+        try:
+            time.sleep(wait)
+        finally:
+            _amocrm_dequeue()
+
+async def amocrm_rate_acquire_async():
+    """asyncio version — same bucket, so threads and coroutines share the budget."""
+    wait = _amocrm_reserve()
+    if wait > 0:
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            _amocrm_dequeue()
+
+def amocrm_rate_penalty(seconds=1.0):
+    """After a 429, hold everyone back instead of letting the next caller hit it again."""
+    with _amocrm_bucket_lock:
+        # Refill up to now first, or the next reserve credits time from before the 429 against the penalty
+        now = time.monotonic()
+        tokens = min(AMOCRM_BURST, _amocrm_bucket["tokens"] + (now - _amocrm_bucket["updated"]) * AMOCRM_RATE_PER_SEC)
+        _amocrm_bucket["tokens"], _amocrm_bucket["updated"] = min(tokens, -seconds * AMOCRM_RATE_PER_SEC), now
+        _amocrm_limiter_stats["throttled"] += 1
+
+def get_amocrm_limiter_stats():
+    with _amocrm_bucket_lock:
+        st = dict(_amocrm_limiter_stats)
+    st["wait_avg"] = round(st["wait_total"] / st["waited"], 3) if st["waited"] else 0.0
+    st["wait_total"] = round(st["wait_total"], 2)
+    st["wait_max"] = round(st["wait_max"], 2)
+    st["rate_per_sec"] = AMOCRM_RATE_PER_SEC
+    return st
+
+AMOCRM_TIMEOUT = 30
+AMOCRM_MAX_RETRIES = int(os.environ.get("AMOCRM_MAX_RETRIES", "4"))
+AMOCRM_MAX_BACKOFF = 30   # seconds
+
+_amocrm_session = requests.Session()
+_amocrm_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=10))
+
+def _retry_after_seconds(value):
+    """Retry-After is either delta-seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def amocrm_request(endpoint, params=None, method="GET"):
+    """
+    One amoCRM API v4 call over the shared keep-alive session.
+    429 / 5xx / network errors are retried with exponential backoff + jitter
+    (or the server's Retry-After). Returns parsed JSON, or None if the call
+    was refused (403) or still failing after AMOCRM_MAX_RETRIES.
+    """
+    if not AMOCRM_TOKEN:
+        print("amoCRM token not configured")
+        return None
+    url = f"https://{AMOCRM_DOMAIN}/api/v4/{endpoint}"
+    headers = {"Authorization": f"Bearer {AMOCRM_TOKEN}"}
+    for attempt in range(AMOCRM_MAX_RETRIES + 1):
+        retry_after = None
+        amocrm_rate_acquire()
+        try:
+            resp = _amocrm_session.request(method, url, headers=headers, params=params or {}, timeout=AMOCRM_TIMEOUT)
+        except requests.RequestException as e:
+            status = f"network error: {e}"
+        else:
+            if resp.status_code == 204:
+                return {"_embedded": {}}
+            if resp.status_code == 200:
+                try:
+                    return resp.json()
+                except ValueError:
+                    # Maintenance pages and proxy errors come back as 200 with HTML or nothing
+                    print(f"amoCRM non-JSON 200 on [{endpoint[:80]}]: {resp.text[:150]!r}")
+                    return None
+            elif resp.status_code == 403:
+                print(f"amoCRM 403 scope error on [{endpoint[:80]}] — skipping")
+                return None  # graceful skip, not an error
+            elif resp.status_code != 429 and resp.status_code < 500:
+                print(f"amoCRM error {resp.status_code} on [{endpoint[:80]}]: {resp.text[:150]}")
+                return None
+            status = resp.status_code
+            retry_after = _retry_after_seconds(resp.headers.get("Retry-After"))
+            if status == 429:
+                amocrm_rate_penalty(retry_after or 1.0)
+        if attempt == AMOCRM_MAX_RETRIES:
+            break
+        if retry_after is None:
+            retry_after = min(AMOCRM_MAX_BACKOFF, 0.5 * 2 ** attempt) + random.uniform(0, 0.5)
+        wait = min(retry_after, AMOCRM_MAX_BACKOFF)
+        print(f"amoCRM {status} on [{endpoint[:80]}], retry {attempt + 1}/{AMOCRM_MAX_RETRIES} in {wait:.1f}s")
+        time.sleep(wait)
+    print(f"amoCRM gave up on [{endpoint[:80]}] after {AMOCRM_MAX_RETRIES + 1} attempts")
+    return None
+
+def get_amocrm_pipelines():
+    data = amocrm_request("leads/pipelines")
+    if not data:
+        return []
+    pipelines = []
+    for p in (data.get("_embedded") or {}).get("pipelines") or []:
+        stages = []
+        for s in (p.get("_embedded") or {}).get("statuses") or []:
+            stages.append({
+                "id": s.get("id"),
+                "name": s.get("name"),
+                "sort": s.get("sort", 0),
+                "is_closed": s.get("type", 0) in [0, 1],
+            })
+        stages.sort(key=lambda x: x["sort"])
+        pipelines.append({
+            "id": p.get("id"),
+            "name": p.get("name"),
+            "stages": stages,
+        })
+    return pipelines
+
+# ============================================================
+# amoCRM STAGE REGISTRY — pipelines, stage names, won/lost sets, shared by all analytics
+# ============================================================
+AMOCRM_PIPELINES_TTL = 3600          # stages rarely change
+AMOCRM_UNKNOWN_STAGE_REFRESH = 300   # min seconds between refreshes caused by an unknown status_id
+
+# === iStudio amoCRM stage IDs (verified via /debug) ===
+# Рабочая воронка (5896168):
+#   52041937 = "Пробная процедура выполнена" ← ВЫРУЧКА
+#   143      = "Закрыто и не реализовано"    ← ПОТЕРЯ
+# Постоянные клиенты (8703286):
+#   70503946 = "Процедура выполнена"          ← ВЫРУЧКА
+#   143      = "Закрыто и не реализовано"    ← ПОТЕРЯ
+# Архив (5891302) / Догрев (5896195) — не считаем
+KNOWN_WON_IDS  = {52041937, 70503946}
+KNOWN_LOST_IDS = {143}
+
+_stage_registry = {"pipelines": [], "stage_map": {}, "won_ids": frozenset(), "lost_ids": frozenset(),
+                   "stage_rank": {}, "loaded_at": 0, "unknown_refresh_at": 0}
+_stage_registry_lock = threading.Lock()
+
+def _classify_stage(sid, name):
+    name_lower = (name or "").lower()
+    if sid in KNOWN_WON_IDS:
+        return "won"
+    if sid in KNOWN_LOST_IDS:
+        return "lost"
+    # Fallback for any future new stages
+    if "не реализовано" in name_lower or "закрыто и не" in name_lower:
+        return "lost"
+    if name_lower in ("процедура выполнена", "пробная процедура выполнена", "успешно реализовано"):
+        return "won"
+    return None
+
+def get_stage_registry(force=False, status_ids=None):
+    """
+    Pipelines and stage lookups kept in memory for AMOCRM_PIPELINES_TTL seconds.
+    status_ids (e.g. from the deals being analysed) that are missing from the map
+    trigger an early refresh, at most once per AMOCRM_UNKNOWN_STAGE_REFRESH.
+    """
+    with _stage_registry_lock:
+        now = time.time()
+        stale = now - _stage_registry["loaded_at"] >= AMOCRM_PIPELINES_TTL
+        if not force and not stale and status_ids:
+            unknown = set(status_ids) - set(_stage_registry["stage_map"])
+            if unknown and now - _stage_registry["unknown_refresh_at"] >= AMOCRM_UNKNOWN_STAGE_REFRESH:
+                print(f"amoCRM: unknown stage ids {sorted(unknown)[:5]} — refreshing pipelines")
+                _stage_registry["unknown_refresh_at"] = now
+                force = True
+        if not force and not stale:
+            return dict(_stage_registry)
+        pipelines = get_amocrm_pipelines()
+        if not pipelines:
+            return dict(_stage_registry)   # keep the last good map if amoCRM is unavailable
+        stage_map, won, lost, rank = {}, set(), set(), {}
+        for p in pipelines:
+            # Ranked per pipeline: the shared system stages (142/143) sit at each pipeline's own end
+            for position, s in enumerate(p["stages"]):
+                stage_map[s["id"]] = s["name"]
+                rank[(p["id"], s["id"])] = position
+                kind = _classify_stage(s["id"], s["name"])
+                if kind == "won":
+                    won.add(s["id"])
+                elif kind == "lost":
+                    lost.add(s["id"])
+        _stage_registry.update({
+            "pipelines": pipelines,
+            "stage_map": stage_map,
+            "won_ids": frozenset(won),
+            "lost_ids": frozenset(lost),
+            "stage_rank": rank,
+            "loaded_at": now,
+        })
+        print(f"amoCRM stages: {len(stage_map)} in {len(pipelines)} pipelines | WON ids={sorted(won)} | LOST ids={sorted(lost)}")
+        return dict(_stage_registry)
+
+def refresh_stage_registry():
+    return get_stage_registry(force=True)
+
+AMOCRM_PAGE_SIZE = 250        # amoCRM v4 maximum
+AMOCRM_PAGE_WORKERS = 5       # pages in flight at once (the token bucket still sets the pace)
+AMOCRM_MAX_PAGES = int(os.environ.get("AMOCRM_MAX_PAGES", "400"))   # safety cap: 100k records
+
+def amocrm_paginate(endpoint, params, embedded_key, max_pages=None):
+    """
+    Load every page of a list endpoint: page 1 first, then the following pages
+    concurrently in waves of AMOCRM_PAGE_WORKERS until a short/empty page.
+    Returns (items, status) with status = {"complete", "truncated_at", "failed_page", "pages"}:
+    truncated_at is set when max_pages was reached with more data still there.
+    """
+    max_pages = max_pages or AMOCRM_MAX_PAGES
+    status = {"complete": True, "truncated_at": None, "failed_page": None, "pages": 0}
+
+    def _page(n):
+        return amocrm_request(endpoint, {**params, "limit": AMOCRM_PAGE_SIZE, "page": n})
+
+    items = []
+    first = _page(1)
+    if first is None:
+        status.update(complete=False, failed_page=1)
+        return items, status
+    page_items = (first.get("_embedded") or {}).get(embedded_key) or []
+    items.extend(page_items)
+    status["pages"] = 1
+    if len(page_items) < AMOCRM_PAGE_SIZE:
+        return items, status
+
+    next_page = 2
+    with ThreadPoolExecutor(max_workers=AMOCRM_PAGE_WORKERS) as ex:
+        while True:
+            wave = list(range(next_page, min(next_page + AMOCRM_PAGE_WORKERS, max_pages + 1)))
+            if not wave:
+                status.update(complete=False, truncated_at=len(items))
+                print(f"amoCRM {endpoint}: stopped at {max_pages} pages — truncated at {len(items)}")
+                return items, status
+            for n, data in zip(wave, ex.map(_page, wave)):
+                if data is None:
+                    status.update(complete=False, failed_page=n)
+                    print(f"amoCRM {endpoint}: page {n} failed — list is incomplete ({len(items)} loaded)")
+                    return items, status
+                page_items = (data.get("_embedded") or {}).get(embedded_key) or []
+                items.extend(page_items)
+                status["pages"] = n
+                if len(page_items) < AMOCRM_PAGE_SIZE:
+                    return items, status
+            next_page = wave[-1] + 1
+
+def iter_amocrm_updated(endpoint, params, embedded_key, updated_from, status, max_pages=None):
+    """
+    Keyset paging by updated_at, oldest first: every page restarts from the
+    newest updated_at seen (filter[updated_at][from]), so a record edited
+    mid-sync — jumping to the end of the order — can't shift unread records
+    onto pages already read, as offset paging would. A full page inside one
+    second (bulk edits) can't move the cursor and is stepped through by page
+    number. Yields non-empty pages of items; status (amocrm_paginate's shape)
+    is updated as it goes.
+    """
+    max_pages = max_pages or AMOCRM_MAX_PAGES
+    cursor, page, loaded = updated_from, 1, 0
+    while True:
+        if status["pages"] >= max_pages:
+            status.update(complete=False, truncated_at=loaded)
+            print(f"amoCRM {endpoint}: stopped at {max_pages} pages — {loaded} loaded, the rest follows next sync")
+            return
+        page_params = {**params, "order[updated_at]": "asc", "limit": AMOCRM_PAGE_SIZE, "page": page}
+        if cursor:
+            page_params["filter[updated_at][from]"] = cursor
+        data = amocrm_request(endpoint, page_params)
+        if data is None:
+            status.update(complete=False, failed_page=status["pages"] + 1)
+            return
+        items = (data.get("_embedded") or {}).get(embedded_key) or []
+        status["pages"] += 1
+        if items:
+            loaded += len(items)
+            yield items
+            newest = max(i.get("updated_at", 0) or 0 for i in items)
+            if newest > cursor:
+                cursor, page = newest, 1
+            else:
+                page += 1
+        if len(items) < AMOCRM_PAGE_SIZE:
+            return
+
+# ============================================================
+# amoCRM DEAL MIRROR — local copy of leads, kept current by updated_at deltas
+# ============================================================
+AMOCRM_DEALS_SYNC_TTL = int(os.environ.get("AMOCRM_DEALS_SYNC_TTL", "60"))   # seconds between delta syncs
+AMOCRM_SYNC_OVERLAP = 300   # re-read changes from the last 5 minutes before the watermark
+
+_deals_sync_lock = threading.Lock()
+_deals_sync = {"at": 0, "status": {"complete": False, "truncated_at": None, "failed_page": None, "pages": 0}}
+
+def _deal_row(deal):
+    emb = deal.get("_embedded") or {}
+    return (
+        deal.get("id"), deal.get("name", ""), deal.get("price", 0) or 0,
+        deal.get("pipeline_id"), deal.get("status_id"),
+        deal.get("created_at", 0) or 0, deal.get("closed_at", 0) or 0, deal.get("updated_at", 0) or 0,
+        json.dumps([t.get("name", "") for t in emb.get("tags") or []], ensure_ascii=False),
+        json.dumps([c["id"] for c in emb.get("contacts") or []]),
+        1 if deal.get("is_deleted") else 0,
+    )
+
+def _deal_from_row(r):
+    """Mirror row → the same dict shape amoCRM returns for leads?with=contacts,tags."""
+    return {
+        "id": r["id"], "name": r["name"], "price": r["price"],
+        "pipeline_id": r["pipeline_id"], "status_id": r["status_id"],
+        "created_at": r["created_at"], "closed_at": r["closed_at"], "updated_at": r["updated_at"],
+        "_embedded": {
+            "tags": [{"name": t} for t in json.loads(r["tags"] or "[]")],
+            "contacts": [{"id": c} for c in json.loads(r["contact_ids"] or "[]")],
+        },
+    }
+
+_DEAL_UPSERT_SQL = (
+    "INSERT OR REPLACE INTO amocrm_deals (id, name, price, pipeline_id, status_id, created_at, closed_at, "
+    "updated_at, tags, contact_ids, is_deleted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+def upsert_mirrored_deals(deals):
+    if not deals:
+        return
+    with _db_lock:
+        conn = get_db()
+        conn.executemany(_DEAL_UPSERT_SQL, [_deal_row(d) for d in deals if d.get("id")])
+        update_deal_rollup(conn, deals)
+        update_contact_ltv(conn, deals)
+        conn.commit()
+
+def sync_amocrm_deals(force=False):
+    """
+    Pull deals changed since the last sync (filter[updated_at][from]) into the mirror.
+    The first run has no watermark and loads the whole account once.
+    Returns the run's status (see amocrm_paginate) plus "delta": True once the
+    mirror has been fully loaded — a failure then only means recent changes are missing.
+    """
+    with _deals_sync_lock:
+        # With webhooks flowing the mirror is already live — deltas are only a safety net
+        ttl = AMOCRM_WEBHOOK_SYNC_TTL if time.time() - _webhook_state["last_at"] < AMOCRM_WEBHOOK_SYNC_TTL else AMOCRM_DEALS_SYNC_TTL
+        if not force and time.time() - _deals_sync["at"] < ttl:
+            return _deals_sync["status"]
+        watermark = int(get_sync_state("amocrm_deals_updated_at", 0))
+        base_loaded = bool(get_sync_state("amocrm_deals_base_loaded"))
+        status = {"complete": True, "truncated_at": None, "failed_page": None, "pages": 0, "delta": base_loaded}
+        changed = 0
+        # Oldest changes first, so a partial run can still advance the watermark safely
+        for deals in iter_amocrm_updated("leads", {"with": "contacts,tags"}, "leads",
+                                         max(watermark - AMOCRM_SYNC_OVERLAP, 0) if watermark else 0, status):
+            upsert_mirrored_deals(deals)
+            changed += len(deals)
+            newest = max(d.get("updated_at", 0) or 0 for d in deals)
+            if newest > watermark:
+                watermark = newest
+                set_sync_state("amocrm_deals_updated_at", watermark)
+        if status["complete"] and not base_loaded:
+            set_sync_state("amocrm_deals_base_loaded", int(time.time()))
+        if status["pages"] or status["complete"]:
+            _deals_sync["at"] = time.time()
+        _deals_sync["status"] = status
+        print(f"amoCRM mirror: {changed} changed deals {'(full load)' if not base_loaded else ''}".rstrip())
+        return status
+
+AMOCRM_RECONCILE_HOURS = 24   # full id listing that catches deletions/merges missed without webhooks
+
+def reconcile_amocrm_deals():
+    """
+    Mark mirrored deals that amoCRM no longer lists (deleted, or merged into
+    another lead) as deleted. Ids missing from the listing are checked again by
+    id before anything is dropped, so a page shifted by concurrent deletes
+    can't remove live deals. Returns the number of deals marked deleted.
+    """
+    started = int(time.time())
+    listed, status = amocrm_paginate("leads", {}, "leads")
+    if not status["complete"]:
+        print("amoCRM reconcile: lead listing incomplete — skipped")
+        return 0
+    live = {d.get("id") for d in listed}
+    # Deals synced after the listing began may legitimately be missing from it
+    rows = db_query("SELECT * FROM amocrm_deals WHERE is_deleted = 0 AND updated_at < ?",
+                    (started - AMOCRM_SYNC_OVERLAP,))
+    missing = {r["id"]: r for r in rows if r["id"] not in live}
+    gone = []
+    ids = list(missing)
+    for i in range(0, len(ids), AMOCRM_PAGE_SIZE):
+        batch = ids[i:i + AMOCRM_PAGE_SIZE]
+        data = amocrm_request("leads?" + "&".join(f"filter[id][]={x}" for x in batch), {"limit": AMOCRM_PAGE_SIZE})
+        if data is None:
+            print("amoCRM reconcile: id check failed — stopping")
+            break
+        found = {d.get("id") for d in (data.get("_embedded") or {}).get("leads") or []}
+        gone.extend({**_deal_from_row(missing[x]), "is_deleted": 1} for x in batch if x not in found)
+    upsert_mirrored_deals(gone)
+    print(f"amoCRM reconcile: {len(live)} live deals, {len(gone)} removed from the mirror")
+    return len(gone)
+
+def _sync_deal_mirror():
+    try:
+        return sync_amocrm_deals()
+    except Exception as e:
+        print(f"amoCRM mirror sync error: {e}")
+        return {"complete": False, "truncated_at": None, "failed_page": None, "pages": 0}
+
+def get_crm_deals(date_filter=None):
+    """
+    Deals created within date_filter ({"from", "to"} unix ts, inclusive), read
+    from the local mirror after a delta sync. Returns (deals, status) — see
+    amocrm_paginate.
+    """
+    status = _sync_deal_mirror()
+    sql = "SELECT * FROM amocrm_deals WHERE is_deleted = 0"
+    params = ()
+    if date_filter:
+        sql += " AND created_at >= ? AND created_at <= ?"
+        params = (date_filter.get("from", 0), date_filter.get("to", 0))
+    return [_deal_from_row(r) for r in db_query(sql + " ORDER BY created_at", params)], status
+
+# ============================================================
+# CRM DAILY ROLLUP — deals pre-summed per day and (pipeline, stage, branch, fb tag, campaign tag)
+# ============================================================
+CRM_ROLLUP_VERSION = "1"           # bump when tag parsing changes — facts and rollup are rebuilt from the mirror
+CRM_ROLLUP_REBUILD_CELLS = 2000    # more touched cells than this → re-aggregate the whole table at once
+
+_ROLLUP_DIMS = ("created_day", "closed_day", "pipeline_id", "status_id", "branch", "fb_tag", "campaign_tag")
+_ROLLUP_KEY = ", ".join(_ROLLUP_DIMS)
+_ROLLUP_CELL = " AND ".join(f"{d} = ?" for d in _ROLLUP_DIMS)
+_ROLLUP_AGGREGATE = (f"SELECT {_ROLLUP_KEY}, COUNT(*), SUM(price), SUM(price > 0), "
+                     "MIN(CASE WHEN price > 0 THEN price END), MAX(CASE WHEN price > 0 THEN price END) "
+                     "FROM crm_deal_facts")
+
+_rollup_state = {"ready": False}
+
+def _rollup_day(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d") if ts else ""
+
+def _deal_fact(deal):
+    attrs = deal_tag_attributes(deal)
+    return (
+        deal["id"], _rollup_day(deal.get("created_at")), _rollup_day(deal.get("closed_at")),
+        deal.get("pipeline_id") or 0, deal.get("status_id") or 0, attrs["branch"],
+        attrs["fb_tag"] or "", attrs["campaign"]["raw"] if attrs["campaign"] else "",
+        deal.get("price", 0) or 0,
+    )
+
+_DEAL_FACT_SQL = (
+    "INSERT OR REPLACE INTO crm_deal_facts (deal_id, created_day, closed_day, pipeline_id, status_id, "
+    "branch, fb_tag, campaign_tag, price) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+def _rollup_cells(conn, deal_ids):
+    cells = set()
+    for i in range(0, len(deal_ids), 500):
+        chunk = deal_ids[i:i + 500]
+        cells.update(tuple(r) for r in conn.execute(
+            f"SELECT {_ROLLUP_KEY} FROM crm_deal_facts WHERE deal_id IN ({','.join('?' * len(chunk))})", chunk))
+    return cells
+
+def _rollup_recompute(conn, cells=None):
+    """Re-aggregate the given cells from crm_deal_facts (every cell when None). Caller holds _db_lock."""
+    if cells is None or len(cells) > CRM_ROLLUP_REBUILD_CELLS:
+        conn.execute("DELETE FROM crm_daily_rollup")
+        conn.execute(f"INSERT INTO crm_daily_rollup {_ROLLUP_AGGREGATE} GROUP BY {_ROLLUP_KEY}")
+        return
+    for cell in cells:
+        conn.execute(f"DELETE FROM crm_daily_rollup WHERE {_ROLLUP_CELL}", cell)
+        conn.execute(f"INSERT INTO crm_daily_rollup {_ROLLUP_AGGREGATE} WHERE {_ROLLUP_CELL} GROUP BY {_ROLLUP_KEY}", cell)
+
+def _rollup_built():
+    if not _rollup_state["ready"]:
+        _rollup_state["ready"] = get_sync_state("crm_rollup_version") == CRM_ROLLUP_VERSION
+    return _rollup_state["ready"]
+
+def update_deal_rollup(conn, deals):
+    """
+    Move changed mirror deals (deleted ones included) into crm_deal_facts and
+    re-aggregate only the rollup cells they left or entered. Caller holds
+    _db_lock and commits. Until the rollup is built this is a no-op —
+    ensure_crm_rollup() builds it from the whole mirror.
+    """
+    if not _rollup_built():
+        return
+    ids = list({d["id"] for d in deals if d.get("id")})
+    if not ids:
+        return
+    cells = _rollup_cells(conn, ids)
+    conn.executemany("DELETE FROM crm_deal_facts WHERE deal_id = ?", [(i,) for i in ids])
+    conn.executemany(_DEAL_FACT_SQL, [_deal_fact(d) for d in deals if d.get("id") and not d.get("is_deleted")])
+    cells |= _rollup_cells(conn, ids)
+    _rollup_recompute(conn, cells)
+
+def ensure_crm_rollup():
+    """Build facts and rollup from the mirror once per CRM_ROLLUP_VERSION (survives restarts)."""
+    if _rollup_state["ready"]:
+        return
+    with _db_lock:
+        if _rollup_built():
+            return
+        conn = get_db()
+        deals = [_deal_from_row(r) for r in conn.execute("SELECT * FROM amocrm_deals WHERE is_deleted = 0")]
+        conn.execute("DELETE FROM crm_deal_facts")
+        conn.executemany(_DEAL_FACT_SQL, [_deal_fact(d) for d in deals])
+        _rollup_recompute(conn)
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                     ("crm_rollup_version", CRM_ROLLUP_VERSION))
+        conn.commit()
+        _rollup_state["ready"] = True
+        print(f"CRM rollup: built from {len(deals)} mirrored deals")
+
+def get_crm_rollup(since=None, until=None):
+    """
+    Rollup rows for deals created in [since, until] (all time without a period),
+    summed over days — one row per (pipeline, stage, branch, fb tag, campaign tag).
+    Syncs the mirror first; returns (rows, status) like get_crm_deals.
+    """
+    status = _sync_deal_mirror()
+    ensure_crm_rollup()
+    sql = ("SELECT pipeline_id, status_id, branch, fb_tag, campaign_tag, SUM(deals) AS deals, "
+           "SUM(price_sum) AS price_sum, SUM(priced) AS priced, MIN(min_price) AS min_price, "
+           "MAX(max_price) AS max_price FROM crm_daily_rollup")
+    params = ()
+    if since and until:
+        sql += " WHERE created_day BETWEEN ? AND ?"
+        params = (since, until)
+    sql += " GROUP BY pipeline_id, status_id, branch, fb_tag, campaign_tag ORDER BY MIN(created_day)"
+    return db_query(sql, params), status
+
+# ============================================================
+# CONTACT LTV — per-contact deal aggregates, kept in memory and in crm_contact_ltv
+# ============================================================
+CONTACT_LTV_VERSION = "1"   # bump when the aggregates change shape — they are then rebuilt from the mirror
+
+_contact_ltv = {"ready": False, "clients": None}   # clients: {contact_id: [bucket, ...]} once loaded
+
+def _deal_contact_ids(deal):
+    return {c["id"] for c in (deal.get("_embedded") or {}).get("contacts") or [] if c.get("id")}
+
+def _contact_ltv_buckets(deals):
+    """One contact's deals → aggregates per (branch, created day)."""
+    buckets = {}
+    for d in deals:
+        attrs = deal_tag_attributes(d)
+        created = d.get("created_at", 0) or 0
+        key = (attrs["branch"], _rollup_day(created))
+        b = buckets.get(key)
+        if b is None:
+            b = buckets[key] = {"branch": key[0], "day": key[1], "deals": 0, "total_spent": 0,
+                                "first_deal": 0, "last_deal": 0, "statuses": {},
+                                "campaigns": set(), "fb_tags": set(), "names": set()}
+        b["deals"] += 1
+        b["total_spent"] += d.get("price", 0) or 0
+        if created:
+            b["first_deal"] = min(b["first_deal"] or created, created)
+            b["last_deal"] = max(b["last_deal"], created)
+        sid = d.get("status_id", 0)
+        b["statuses"][sid] = b["statuses"].get(sid, 0) + 1
+        if attrs["campaign"]:
+            b["campaigns"].add(attrs["campaign"]["raw"])
+        if attrs["fb_tag"]:
+            b["fb_tags"].add(attrs["fb_tag"])
+        if d.get("name"):
+            b["names"].add(d["name"])
+    return list(buckets.values())
+
+def _contact_ltv_row(contact_id, b):
+    return (contact_id, b["branch"], b["day"], b["deals"], b["total_spent"], b["first_deal"], b["last_deal"],
+            json.dumps(b["statuses"]), json.dumps(sorted(b["campaigns"]), ensure_ascii=False),
+            json.dumps(sorted(b["fb_tags"]), ensure_ascii=False), json.dumps(sorted(b["names"]), ensure_ascii=False))
+
+def _contact_ltv_bucket(r):
+    return {"branch": r["branch"], "day": r["created_day"], "deals": r["deals"], "total_spent": r["total_spent"],
+            "first_deal": r["first_deal"], "last_deal": r["last_deal"],
+            "statuses": {int(k): v for k, v in json.loads(r["statuses"] or "{}").items()},
+            "campaigns": set(json.loads(r["campaigns"] or "[]")), "fb_tags": set(json.loads(r["fb_tags"] or "[]")),
+            "names": set(json.loads(r["names"] or "[]"))}
+
+_CONTACT_LTV_SQL = (
+    "INSERT OR REPLACE INTO crm_contact_ltv (contact_id, branch, created_day, deals, total_spent, first_deal, "
+    "last_deal, statuses, campaigns, fb_tags, names) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+def _store_contact_ltv(conn, deals_by_contact):
+    """Replace the aggregates of these contacts (no deals → removed). Caller holds _db_lock."""
+    conn.executemany("DELETE FROM crm_contact_ltv WHERE contact_id = ?", [(cid,) for cid in deals_by_contact])
+    rows = []
+    for cid, deals in deals_by_contact.items():
+        buckets = _contact_ltv_buckets(deals)
+        rows.extend(_contact_ltv_row(cid, b) for b in buckets)
+        if _contact_ltv["clients"] is not None:
+            if buckets:
+                _contact_ltv["clients"][cid] = buckets
+            else:
+                _contact_ltv["clients"].pop(cid, None)
+    conn.executemany(_CONTACT_LTV_SQL, rows)
+
+def _contact_ltv_built():
+    if not _contact_ltv["ready"]:
+        _contact_ltv["ready"] = get_sync_state("contact_ltv_version") == CONTACT_LTV_VERSION
+    return _contact_ltv["ready"]
+
+def update_contact_ltv(conn, deals):
+    """
+    Re-aggregate every contact a changed mirror deal was or is linked to, from
+    that contact's live mirrored deals. Caller holds _db_lock and commits.
+    A no-op until ensure_contact_ltv() has built the table.
+    """
+    if not _contact_ltv_built():
+        return
+    ids = list({d["id"] for d in deals if d.get("id")})
+    if not ids:
+        return
+    touched = set()
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        touched.update(r[0] for r in conn.execute(
+            f"SELECT contact_id FROM crm_contact_deals WHERE deal_id IN ({','.join('?' * len(chunk))})", chunk))
+    conn.executemany("DELETE FROM crm_contact_deals WHERE deal_id = ?", [(i,) for i in ids])
+    links = {(cid, d["id"]) for d in deals if d.get("id") and not d.get("is_deleted") for cid in _deal_contact_ids(d)}
+    conn.executemany("INSERT OR IGNORE INTO crm_contact_deals (contact_id, deal_id) VALUES (?, ?)", links)
+    touched.update(cid for cid, _ in links)
+    deals_by_contact = {cid: [] for cid in touched}
+    touched = list(touched)
+    for i in range(0, len(touched), 500):
+        chunk = touched[i:i + 500]
+        for r in conn.execute(
+                "SELECT l.contact_id AS link_contact_id, d.* FROM crm_contact_deals l "
+                "JOIN amocrm_deals d ON d.id = l.deal_id "
+                f"WHERE l.contact_id IN ({','.join('?' * len(chunk))}) AND d.is_deleted = 0", chunk):
+            deals_by_contact[r["link_contact_id"]].append(_deal_from_row(r))
+    _store_contact_ltv(conn, deals_by_contact)
+
+def ensure_contact_ltv():
+    """Build links and aggregates from the mirror once per CONTACT_LTV_VERSION, then load them into memory."""
+    if _contact_ltv["clients"] is not None:
+        return
+    with _db_lock:
+        if _contact_ltv["clients"] is not None:
+            return
+        conn = get_db()
+        if not _contact_ltv_built():
+            deals_by_contact = defaultdict(list)
+            for r in conn.execute("SELECT * FROM amocrm_deals WHERE is_deleted = 0"):
+                deal = _deal_from_row(r)
+                for cid in _deal_contact_ids(deal):
+                    deals_by_contact[cid].append(deal)
+            conn.execute("DELETE FROM crm_contact_deals")
+            conn.execute("DELETE FROM crm_contact_ltv")
+            conn.executemany("INSERT OR IGNORE INTO crm_contact_deals (contact_id, deal_id) VALUES (?, ?)",
+                             [(cid, d["id"]) for cid, deals in deals_by_contact.items() for d in deals])
+            _store_contact_ltv(conn, deals_by_contact)
+            conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                         ("contact_ltv_version", CONTACT_LTV_VERSION))
+            conn.commit()
+            _contact_ltv["ready"] = True
+            print(f"Contact LTV: built for {len(deals_by_contact)} contacts")
+        clients = defaultdict(list)
+        for r in conn.execute("SELECT * FROM crm_contact_ltv"):
+            clients[r["contact_id"]].append(_contact_ltv_bucket(r))
+        _contact_ltv["clients"] = dict(clients)
+
+def get_contact_ltv(since=None, until=None):
+    """
+    Per-contact totals over deals created in [since, until] (all time without a
+    period) whose branch passes should_filter_branch: {contact_id: {"deals",
+    "won", "total_spent", "first_deal", "last_deal", "campaigns", "fb_tags",
+    "branches", "names"}}. Summed from memory after a mirror sync; returns
+    (clients, status) like get_crm_deals.
+    """
+    status = _sync_deal_mirror()
+    ensure_contact_ltv()
+    with _db_lock:
+        snapshot = list(_contact_ltv["clients"].items())
+    keep_branch = {}
+    clients = {}
+    for cid, buckets in snapshot:
+        agg = None
+        for b in buckets:
+            if since and until and not since <= b["day"] <= until:
+                continue
+            keep = keep_branch.get(b["branch"])
+            if keep is None:
+                keep = keep_branch[b["branch"]] = should_filter_branch(b["branch"], since, until)
+            if not keep:
+                continue
+            if agg is None:
+                agg = clients[cid] = {"deals": 0, "total_spent": 0, "first_deal": 0, "last_deal": 0, "statuses": {},
+                                      "campaigns": set(), "fb_tags": set(), "branches": set(), "names": set()}
+            agg["deals"] += b["deals"]
+            agg["total_spent"] += b["total_spent"]
+            if b["first_deal"]:
+                agg["first_deal"] = min(agg["first_deal"] or b["first_deal"], b["first_deal"])
+            agg["last_deal"] = max(agg["last_deal"], b["last_deal"])
+            for sid, count in b["statuses"].items():
+                agg["statuses"][sid] = agg["statuses"].get(sid, 0) + count
+            agg["campaigns"] |= b["campaigns"]
+            agg["fb_tags"] |= b["fb_tags"]
+            agg["branches"].add(b["branch"])
+            agg["names"] |= b["names"]
+
+    won_ids = get_stage_registry(status_ids={sid for agg in clients.values() for sid in agg["statuses"]})["won_ids"]
+    for agg in clients.values():
+        agg["won"] = sum(count for sid, count in agg.pop("statuses").items() if sid in won_ids)
+        for key in ("campaigns", "fb_tags", "branches", "names"):
+            agg[key] = list(agg[key])
+    return clients, status
+
+# ============================================================
+# amoCRM WEBHOOKS — live updates for the deal/contact mirror
+# ============================================================
+AMOCRM_WEBHOOK_PORT = int(os.environ.get("AMOCRM_WEBHOOK_PORT", "0"))   # 0 = receiver disabled
+AMOCRM_WEBHOOK_SECRET = os.environ.get("AMOCRM_WEBHOOK_SECRET", "")
+AMOCRM_WEBHOOK_RECORD = os.environ.get("AMOCRM_WEBHOOK_RECORD", "")     # append raw payloads here for replay
+AMOCRM_WEBHOOK_SYNC_TTL = 900     # delta-sync interval while webhooks keep arriving
+AMOCRM_WEBHOOK_LOG_DAYS = 7       # how long applied event keys are remembered
+AMOCRM_WEBHOOK_MAX_BODY = 1024 * 1024   # larger requests get 413 without being read
+
+_webhook_state = {"running": False, "received": 0, "applied": 0, "duplicates": 0,
+                  "stale": 0, "rejected": 0, "last_at": 0, "pruned_at": 0}
+_webhook_state_lock = threading.Lock()   # receiver threads update the counters concurrently
+
+def _parse_amocrm_form(body):
+    """
+    amoCRM posts x-www-form-urlencoded keys like leads[update][0][tags][1][name].
+    Builds the nested structure; dicts with only numeric keys become lists.
+    """
+    root = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = re.findall(r"[^\[\]]+", key)
+        if not parts:
+            continue
+        node = root
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        node[parts[-1]] = value
+
+    def listify(node):
+        if not isinstance(node, dict):
+            return node
+        node = {k: listify(v) for k, v in node.items()}
+        if node and all(k.isdigit() for k in node):
+            return [node[k] for k in sorted(node, key=int)]
+        return node
+    return listify(root)
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict):
+        return list(value.values())
+    return [value] if value not in (None, "") else []
+
+def _to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def amocrm_webhook_signature(body):
+    return hmac.new(AMOCRM_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+def _webhook_authorized(query, body, headers):
+    """Shared secret in ?secret=… (amoCRM webhook URL) or HMAC-SHA256 of the body in X-Signature."""
+    if not AMOCRM_WEBHOOK_SECRET:
+        return False
+    token = (parse_qs(query).get("secret") or [""])[0]
+    if token and hmac.compare_digest(token, AMOCRM_WEBHOOK_SECRET):
+        return True
+    signature = (headers.get("X-Signature") or "").lower()
+    return bool(signature) and hmac.compare_digest(signature, amocrm_webhook_signature(body))
+
+def _webhook_event_key(entity, action, item):
+    stamp = item.get("updated_at") or item.get("last_modified") or ""
+    raw = f"{entity}:{action}:{item.get('id')}:{stamp}:{item.get('status_id', '')}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+def _apply_webhook_lead(conn, action, item, names):
+    deal_id = _to_int(item.get("id"))
+    row = conn.execute("SELECT * FROM amocrm_deals WHERE id = ?", (deal_id,)).fetchone()
+    if action == "delete":
+        conn.execute("UPDATE amocrm_deals SET is_deleted = 1 WHERE id = ?", (deal_id,))
+        update_deal_rollup(conn, [{"id": deal_id, "is_deleted": 1}])
+        update_contact_ltv(conn, [{"id": deal_id, "is_deleted": 1}])
+        return True
+    updated_at = _to_int(item.get("updated_at") or item.get("last_modified"))
+    if row and updated_at and row["updated_at"] > updated_at:
+        return False   # out-of-order delivery, the mirror already has newer data
+    deal = _deal_from_row(row) if row else {"id": deal_id, "_embedded": {"tags": [], "contacts": []}}
+    if "name" in item:
+        deal["name"] = item["name"]
+    for field, aliases in (("price", ("price",)), ("pipeline_id", ("pipeline_id",)), ("status_id", ("status_id",)),
+                           ("created_at", ("created_at", "date_create")), ("closed_at", ("closed_at", "date_close"))):
+        for alias in aliases:
+            if item.get(alias) not in (None, ""):
+                deal[field] = _to_int(item[alias])
+                break
+    deal["updated_at"] = updated_at or deal.get("updated_at", 0)
+    if "tags" in item:
+        deal["_embedded"]["tags"] = [{"name": t.get("name", "")} for t in _as_list(item["tags"]) if isinstance(t, dict)]
+    if deal.get("status_id") in (142, 143) and not deal.get("closed_at"):
+        deal["closed_at"] = deal["updated_at"] or int(time.time())
+    # Lead webhooks don't carry contact links — existing ones are kept, new deals get them from the next delta sync
+    conn.execute(_DEAL_UPSERT_SQL, _deal_row(deal))
+    update_deal_rollup(conn, [deal])
+    update_contact_ltv(conn, [deal])
+    return True
+
+def _apply_webhook_contact(conn, action, item, names):
+    # Name changes are collected in names ({id: name}) and reach the name index after _db_lock is released
+    contact_id = _to_int(item.get("id"))
+    if action == "delete":
+        conn.execute("UPDATE amocrm_contacts SET is_deleted = 1 WHERE id = ?", (contact_id,))
+        conn.execute("DELETE FROM amocrm_contact_phones WHERE contact_id = ?", (contact_id,))
+        names[contact_id] = ""
+        return True
+    updated_at = _to_int(item.get("updated_at") or item.get("last_modified"))
+    row = conn.execute("SELECT updated_at, lead_ids FROM amocrm_contacts WHERE id = ?", (contact_id,)).fetchone()
+    if row and updated_at and row["updated_at"] > updated_at:
+        return False
+    custom_fields = [{
+        "field_id": _to_int(cf.get("id")) or None,
+        "field_name": cf.get("name", ""),
+        "field_code": cf.get("code", ""),
+        "values": [{"value": v.get("value", "")} if isinstance(v, dict) else {"value": v}
+                   for v in _as_list(cf.get("values"))],
+    } for cf in _as_list(item.get("custom_fields")) if isinstance(cf, dict)]
+    if "linked_leads_id" in item:
+        lead_ids = [_to_int(x) for x in _as_list(item["linked_leads_id"]) if _to_int(x)]
+    else:
+        lead_ids = json.loads(row["lead_ids"] or "[]") if row else []
+    conn.execute(
+        "INSERT OR REPLACE INTO amocrm_contacts (id, name, custom_fields, lead_ids, updated_at, is_deleted) "
+        "VALUES (?, ?, ?, ?, ?, 0)",
+        (contact_id, item.get("name", ""), json.dumps(custom_fields, ensure_ascii=False),
+         json.dumps(lead_ids), updated_at))
+    _index_contact_phones(conn, contact_id, custom_fields)
+    names[contact_id] = item.get("name", "")
+    return True
+
+def apply_amocrm_webhook(body):
+    """
+    Apply one webhook payload to the local store. Every event is recorded in
+    amocrm_webhook_log first, so re-delivered events are skipped.
+    """
+    payload = _parse_amocrm_form(body)
+    stats = {"applied": 0, "duplicates": 0, "stale": 0}
+    names = {}
+    now = int(time.time())
+    with _db_lock:
+        conn = get_db()
+        for entity, apply in (("leads", _apply_webhook_lead), ("contacts", _apply_webhook_contact)):
+            events = payload.get(entity)
+            if not isinstance(events, dict):
+                continue
+            for action, items in events.items():
+                for item in _as_list(items):
+                    if not isinstance(item, dict) or not _to_int(item.get("id")):
+                        continue
+                    cur = conn.execute(
+                        "INSERT OR IGNORE INTO amocrm_webhook_log (event_key, entity, action, entity_id, received_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (_webhook_event_key(entity, action, item), entity, action, _to_int(item["id"]), now))
+                    if cur.rowcount == 0:
+                        stats["duplicates"] += 1
+                    elif apply(conn, action, item, names):
+                        stats["applied"] += 1
+                    else:
+                        stats["stale"] += 1
+        if now - _webhook_state["pruned_at"] > 3600:
+            conn.execute("DELETE FROM amocrm_webhook_log WHERE received_at < ?", (now - AMOCRM_WEBHOOK_LOG_DAYS * 86400,))
+            _webhook_state["pruned_at"] = now
+        conn.commit()
+    name_index_update(names)
+    with _webhook_state_lock:
+        for key, value in stats.items():
+            _webhook_state[key] += value
+        _webhook_state["last_at"] = time.time()
+    return stats
+
+class _AmoWebhookHandler(BaseHTTPRequestHandler):
+    def _reply(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(200, {"ok": True})
+
+    def do_POST(self):
+        with _webhook_state_lock:
+            _webhook_state["received"] += 1
+        # Reject before reading: no length (411), a bad one (400) or too big (413)
+        header = self.headers.get("Content-Length")
+        try:
+            length = int(header) if header is not None else None
+        except ValueError:
+            length = -1
+        if length is None or not 0 <= length <= AMOCRM_WEBHOOK_MAX_BODY:
+            with _webhook_state_lock:
+                _webhook_state["rejected"] += 1
+            self.close_connection = True
+            self._reply(411 if length is None else 413 if length > 0 else 400, {"ok": False})
+            return
+        body = self.rfile.read(length)
+        _, _, query = self.path.partition("?")
+        if not _webhook_authorized(query, body, self.headers):
+            with _webhook_state_lock:
+                _webhook_state["rejected"] += 1
+            self._reply(403, {"ok": False})
+            return
+        if AMOCRM_WEBHOOK_RECORD:
+            with _webhook_state_lock, open(AMOCRM_WEBHOOK_RECORD, "ab") as f:
+                f.write(body + b"\n")
+        try:
+            stats = apply_amocrm_webhook(body.decode("utf-8", "replace"))
+        except Exception as e:
+            print(f"amoCRM webhook error: {e}")
+            self._reply(500, {"ok": False})   # amoCRM re-delivers, the apply log keeps it idempotent
+            return
+        self._reply(200, {"ok": True, **stats})
+
+    def log_message(self, format, *args):
+        pass   # one line per webhook would drown the bot log
+
+def start_amocrm_webhook_server(port=None):
+    """Serve amoCRM webhooks on a daemon thread. Needs AMOCRM_WEBHOOK_SECRET."""
+    port = port or AMOCRM_WEBHOOK_PORT
+    if not port:
+        return None
+    if not AMOCRM_WEBHOOK_SECRET:
+        print("⚠️ AMOCRM_WEBHOOK_SECRET not set — webhook receiver disabled")
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _AmoWebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    _webhook_state["running"] = True
+    return server
+
+def replay_amocrm_webhooks(path, url=None):
+    """
+    Test harness: POST recorded payloads (one urlencoded body per line, as written
+    by AMOCRM_WEBHOOK_RECORD) to a running receiver, signed like a real delivery.
+    """
+    url = url or f"http://127.0.0.1:{AMOCRM_WEBHOOK_PORT}/amocrm/webhook"
+    sent = 0
+    with open(path, "rb") as f:
+        for line in f:
+            body = line.strip()
+            if not body:
+                continue
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}
+            if AMOCRM_WEBHOOK_SECRET:
+                headers["X-Signature"] = amocrm_webhook_signature(body)
+            r = requests.post(url, data=body, headers=headers, timeout=10)
+            print(f"{r.status_code} {r.text[:200]}")
+            sent += 1
+    return sent
+
+# ============================================================
+# amoCRM CONTACT CACHE — contacts by id in SQLite, refreshed by updated_at deltas
+# ============================================================
+AMOCRM_CONTACTS_SYNC_TTL = 300   # seconds between delta syncs
+
+_contacts_sync_lock = threading.Lock()
+_contacts_sync = {"at": 0}
+
+def _contact_row(c):
+    return (
+        c["id"], c.get("name", ""),
+        json.dumps(c.get("custom_fields_values") or [], ensure_ascii=False),
+        json.dumps([lnk["id"] for lnk in ((c.get("_embedded") or {}).get("leads") or [])]),
+        c.get("updated_at", 0) or 0,
+    )
+
+def _contact_from_row(r):
+    """Cache row → the amoCRM contact shape _parse_contact_from_amocrm expects."""
+    return {
+        "id": r["id"], "name": r["name"] or "Без имени", "updated_at": r["updated_at"],
+        "custom_fields_values": json.loads(r["custom_fields"] or "[]"),
+        "_embedded": {"leads": [{"id": i} for i in json.loads(r["lead_ids"] or "[]")]},
+    }
+
+def _index_contact_phones(conn, contact_id, custom_fields_values):
+    """Replace the contact's entries in the phone index (caller holds _db_lock and commits)."""
+    conn.execute("DELETE FROM amocrm_contact_phones WHERE contact_id = ?", (contact_id,))
+    phones = {normalize_phone(v.get("value", ""))
+              for cf in custom_fields_values or [] if cf.get("field_code") == "PHONE"
+              for v in cf.get("values") or []}
+    conn.executemany("INSERT OR IGNORE INTO amocrm_contact_phones (phone, contact_id) VALUES (?, ?)",
+                     [(p, contact_id) for p in phones if p])
+
+def upsert_cached_contacts(contacts):
+    contacts = [c for c in contacts or [] if c.get("id")]
+    if not contacts:
+        return
+    with _db_lock:
+        conn = get_db()
+        conn.executemany(
+            "INSERT OR REPLACE INTO amocrm_contacts (id, name, custom_fields, lead_ids, updated_at, is_deleted) "
+            "VALUES (?, ?, ?, ?, ?, 0)",
+            [_contact_row(c) for c in contacts])
+        for c in contacts:
+            _index_contact_phones(conn, c["id"], c.get("custom_fields_values"))
+        conn.commit()
+    name_index_update({c["id"]: c.get("name", "") for c in contacts})
+
+PHONE_INDEX_VERSION = "2"   # bump when normalize_phone changes — the index is rebuilt from the cache
+
+def reindex_contact_phones():
+    """Rebuild amocrm_contact_phones from cached contacts once per PHONE_INDEX_VERSION."""
+    if get_sync_state("phone_index_version") == PHONE_INDEX_VERSION:
+        return
+    with _db_lock:
+        conn = get_db()
+        rows = conn.execute("SELECT id, custom_fields FROM amocrm_contacts WHERE is_deleted = 0").fetchall()
+        conn.execute("DELETE FROM amocrm_contact_phones")
+        for r in rows:
+            _index_contact_phones(conn, r["id"], json.loads(r["custom_fields"] or "[]"))
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                     ("phone_index_version", PHONE_INDEX_VERSION))
+        conn.commit()
+    print(f"Phone index rebuilt for {len(rows)} contacts")
+
+def backfill_amocrm_contacts():
+    """
+    One-time load of every contact into the cache, so the phone index covers
+    the whole account. Safe to call on every start — it is a no-op once done.
+    """
+    reindex_contact_phones()
+    if get_sync_state("amocrm_contacts_backfilled"):
+        return
+    with _contacts_sync_lock:
+        if not get_sync_state("amocrm_contacts_updated_at"):
+            # Deltas from here on cover whatever changes while the backfill runs
+            set_sync_state("amocrm_contacts_updated_at", int(time.time()))
+    contacts, status = amocrm_paginate("contacts", {"with": "leads"}, "contacts")
+    upsert_cached_contacts(contacts)
+    if status["complete"]:
+        set_sync_state("amocrm_contacts_backfilled", int(time.time()))
+    print(f"amoCRM contact backfill: {len(contacts)} contacts{'' if status['complete'] else ' (incomplete, retry on next start)'}")
+
+def sync_amocrm_contacts(force=False):
+    """
+    Refresh cached contacts changed since the watermark. The cache itself is
+    filled lazily by id (get_cached_contacts), so the first call only sets the
+    watermark instead of downloading the whole account.
+    """
+    with _contacts_sync_lock:
+        if not force and time.time() - _contacts_sync["at"] < AMOCRM_CONTACTS_SYNC_TTL:
+            return
+        watermark = int(get_sync_state("amocrm_contacts_updated_at", 0))
+        if not watermark:
+            set_sync_state("amocrm_contacts_updated_at", int(time.time()))
+            _contacts_sync["at"] = time.time()
+            return
+        status = {"complete": True, "truncated_at": None, "failed_page": None, "pages": 0}
+        changed = 0
+        for contacts in iter_amocrm_updated("contacts", {"with": "leads"}, "contacts",
+                                            max(watermark - AMOCRM_SYNC_OVERLAP, 0), status):
+            upsert_cached_contacts(contacts)
+            changed += len(contacts)
+            # Only past rows that are actually stored — a failed page is re-read next time
+            newest = max(c.get("updated_at", 0) or 0 for c in contacts)
+            if newest > watermark:
+                watermark = newest
+                set_sync_state("amocrm_contacts_updated_at", watermark)
+        if status["pages"]:
+            _contacts_sync["at"] = time.time()
+        if changed:
+            print(f"amoCRM contact cache: {changed} changed contacts")
+
+def amocrm_fetch_by_ids(entity, ids, with_=""):
+    """
+    Bulk {entity}?filter[id][]=… calls, AMOCRM_PAGE_SIZE ids each, run in
+    parallel under the rate limiter. Returns the raw items found (any order).
+    """
+    batches = [ids[i:i + AMOCRM_PAGE_SIZE] for i in range(0, len(ids), AMOCRM_PAGE_SIZE)]
+
+    def _batch(batch_ids):
+        filter_str = "&".join(f"filter[id][]={i}" for i in batch_ids)
+        params = {"limit": AMOCRM_PAGE_SIZE, **({"with": with_} if with_ else {})}
+        data = amocrm_request(f"{entity}?{filter_str}", params)
+        return None if data is None else (data.get("_embedded") or {}).get(entity) or []
+
+    items, failed = [], 0
+    with ThreadPoolExecutor(max_workers=AMOCRM_PAGE_WORKERS) as ex:
+        for batch_items in ex.map(_batch, batches):
+            if batch_items is None:
+                failed += 1
+            else:
+                items.extend(batch_items)
+    if failed:
+        print(f"amoCRM {entity}: {failed}/{len(batches)} batches failed")
+    return items
+
+def get_cached_contacts(contact_ids):
+    """
+    {contact_id: raw amoCRM contact} for the given ids. Only ids missing from
+    the cache are requested from amoCRM; cached ones are kept fresh by
+    sync_amocrm_contacts (and the contact webhooks).
+    """
+    ids = list({int(cid) for cid in contact_ids if cid})
+    if not ids:
+        return {}
     try:
-        resp = requests.get(url, headers=headers, params=params or {}, timeout=30)
-        if resp.status_code == 204:
-            return {"_embedded": {}}
-        if resp.status_code == 200:
-            return resp.json()
-        elif resp.status_code == 403:
-            print(f"amoCRM 403 scope error on [{endpoint[:80]}] — skipping")
-            return None  # graceful skip, not an error
-        else:
-            print(f"amoCRM error {resp.status_code} on [{endpoint[:80]}]: {resp.text[:150]}")
-            return None
+        sync_amocrm_contacts()
     except Exception as e:
-        print(f"amoCRM request error: {e}")
-        return None
-
-def get_amocrm_pipelines():
-    data = amocrm_request("leads/pipelines")
-    if not data:
-        return []
-    pipelines = []
-    for p in (data.get("_embedded") or {}).get("pipelines") or []:
-        stages = []
-        for s in (p.get("_embedded") or {}).get("statuses") or []:
-            stages.append({
-                "id": s.get("id"),
-                "name": s.get("name"),
-                "sort": s.get("sort", 0),
-                "is_closed": s.get("type", 0) in [0, 1],
-            })
-        stages.sort(key=lambda x: x["sort"])
-        pipelines.append({
-            "id": p.get("id"),
-            "name": p.get("name"),
-            "stages": stages,
-        })
-    return pipelines
-
-def get_all_amocrm_deals(max_pages=30, date_filter=None):
-    all_deals = []
-    for page in range(1, max_pages + 1):
-        params = {"limit": 250, "page": page, "with": "contacts,tags"}
-        if date_filter:
-            params["filter[created_at][from]"] = date_filter.get("from", 0)
-            params["filter[created_at][to]"] = date_filter.get("to", 0)
-        data = amocrm_request("leads", params)
-        if not data:
-            break
-        deals = (data.get("_embedded") or {}).get("leads") or []
-        if not deals:
-            break
-        all_deals.extend(deals)
-        if len(deals) < 250:
-            break
-        time.sleep(0.3)
-    return all_deals
+        print(f"amoCRM contact sync error: {e}")
+
+    def _load(chunk):
+        marks = ",".join("?" * len(chunk))
+        return db_query(f"SELECT * FROM amocrm_contacts WHERE is_deleted = 0 AND id IN ({marks})", tuple(chunk))
+
+    found = {}
+    for i in range(0, len(ids), 500):   # stay under SQLite's bound-parameter limit
+        for r in _load(ids[i:i + 500]):
+            found[r["id"]] = _contact_from_row(r)
+    missing = [cid for cid in ids if cid not in found]
+    if missing:
+        print(f"amoCRM contact cache: {len(found)} cached, fetching {len(missing)}")
+        fetched = amocrm_fetch_by_ids("contacts", missing, "leads")
+        upsert_cached_contacts(fetched)
+        found.update({c["id"]: c for c in fetched})
+    return found
 
 def get_amocrm_contacts(contact_ids):
-    contacts = {}
-    if not contact_ids:
-        return contacts
-    unique_ids = list(set(contact_ids))
-    batch_size = 50
-    for i in range(0, len(unique_ids), batch_size):
-        batch = unique_ids[i:i + batch_size]
-        filter_str = "&".join([f"filter[id][]={cid}" for cid in batch])
-        data = amocrm_request(f"contacts?{filter_str}")
-        if data:
-            for c in (data.get("_embedded") or {}).get("contacts") or []:
-                name = c.get("name", "Без имени")
-                phone = ""
-                email = ""
-                for cf in (c.get("custom_fields_values") or []):
-                    field_code = cf.get("field_code", "")
-                    values = cf.get("values") or []
-                    if field_code == "PHONE" and values:
-                        phone = values[0].get("value", "")
-                    elif field_code == "EMAIL" and values:
-                        email = values[0].get("value", "")
-                contacts[c["id"]] = {
-                    "id": c["id"],
-                    "name": name,
-                    "phone": phone,
-                    "email": email,
-                }
-        time.sleep(0.3)
-    return contacts
+    """{contact_id: parsed contact} (name, phone, all_phones, email, custom_fields, lead_ids) from the cache."""
+    return {cid: _parse_contact_from_amocrm(c) for cid, c in get_cached_contacts(contact_ids).items()}
 
 def _parse_contact_from_amocrm(c, query_fallback=""):
     """Extract full contact info from amoCRM contact object."""
@@ -454,43 +2485,212 @@ def _parse_contact_from_amocrm(c, query_fallback=""):
         "custom_fields": custom_fields,
     }
 
-def find_contact_by_name(name):
-    """Search amoCRM contact by name. Returns list of matches."""
-    data = amocrm_request(f"contacts?query={name}&with=leads")
-    if not data:
+# ============================================================
+# CONTACT NAME INDEX — in-memory trigram search over cached contact names
+# ============================================================
+NAME_MATCH_MIN_SCORE = 0.5    # share of the query's trigrams a name must contain
+NAME_MATCH_SPREAD = 0.15      # keep only matches this close to the best score
+
+_CYRILLIC_LATIN = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z",
+    "и": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r",
+    "с": "s", "т": "t", "у": "u", "ф": "f", "х": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sch",
+    "ъ": "", "ы": "i", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+}
+_HEBREW_LATIN = {
+    "א": "a", "ב": "v", "ג": "g", "ד": "d", "ה": "h", "ו": "v", "ז": "z", "ח": "h", "ט": "t",
+    "י": "i", "כ": "k", "ך": "k", "ל": "l", "מ": "m", "ם": "m", "נ": "n", "ן": "n", "ס": "s",
+    "ע": "", "פ": "p", "ף": "f", "צ": "ts", "ץ": "ts", "ק": "k", "ר": "r", "ש": "sh", "ת": "t",
+}
+_TRANSLIT = {**_CYRILLIC_LATIN, **_HEBREW_LATIN}
+# Spelling variants that transliterations of the same name commonly differ in
+_LATIN_FOLDS = (("kh", "h"), ("ph", "f"), ("ck", "k"), ("w", "v"), ("q", "k"), ("x", "ks"), ("j", "i"), ("y", "i"))
+
+def normalize_name(name):
+    """
+    Lower-case Latin skeleton of a name for fuzzy matching: Ирена / Irena / IRENA → irena.
+    Hebrew is written without vowels, so it only matches other Hebrew spellings.
+    """
+    text = unicodedata.normalize("NFKD", (name or "").lower())
+    out = []
+    for ch in text:
+        if unicodedata.combining(ch):
+            continue
+        out.append(_TRANSLIT.get(ch, ch))
+    text = "".join(out)
+    text = re.sub(r"c(?!h)", "k", text)
+    for a, b in _LATIN_FOLDS:
+        text = text.replace(a, b)
+    text = re.sub(r"(.)\1+", r"\1", text)        # Анна / Ana, Julia / Юлия
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+def _name_trigrams(normalized):
+    grams = set()
+    for token in normalized.split():
+        padded = f"  {token} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+# pending: changes that arrive while the index is being built, applied right after the swap
+_name_index = {"loaded": False, "grams": {}, "postings": defaultdict(set), "pending": None}
+_name_index_lock = threading.Lock()   # never held while waiting for _db_lock
+
+def _name_index_put(index, contact_id, name):
+    old = index["grams"].pop(contact_id, ())
+    for g in old:
+        index["postings"][g].discard(contact_id)
+    grams = _name_trigrams(normalize_name(name))
+    if grams:
+        index["grams"][contact_id] = grams
+        for g in grams:
+            index["postings"][g].add(contact_id)
+
+def _ensure_name_index():
+    if _name_index["loaded"]:
+        return
+    with _name_index_lock:
+        if _name_index["pending"] is None:
+            _name_index["pending"] = {}
+    # Read and build outside the index lock, then swap the finished index in
+    rows = db_query("SELECT id, name FROM amocrm_contacts WHERE is_deleted = 0")
+    built = {"grams": {}, "postings": defaultdict(set)}
+    for r in rows:
+        _name_index_put(built, r["id"], r["name"])
+    with _name_index_lock:
+        if _name_index["loaded"]:
+            return
+        for contact_id, name in _name_index["pending"].items():
+            _name_index_put(built, contact_id, name)
+        _name_index.update(built, pending=None, loaded=True)
+    print(f"Contact name index: {len(built['grams'])} names")
+
+def name_index_update(names):
+    """
+    {contact_id: name} → index. Before the first search nothing is kept (the
+    build reads the cache); during the build changes are queued. Must not be
+    called while holding _db_lock.
+    """
+    if not names:
+        return
+    with _name_index_lock:
+        if not _name_index["loaded"]:
+            if _name_index["pending"] is not None:
+                _name_index["pending"].update(names)
+            return
+        for contact_id, name in names.items():
+            _name_index_put(_name_index, contact_id, name)
+
+def search_contact_names(query, limit=5):
+    """Ranked [(contact_id, score)] for a name query; typo-tolerant, Cyrillic and Latin spellings match."""
+    _ensure_name_index()
+    q_grams = _name_trigrams(normalize_name(query))
+    if not q_grams:
         return []
-    contacts = (data.get("_embedded") or {}).get("contacts") or []
-    return [_parse_contact_from_amocrm(c) for c in contacts[:5]]
+    with _name_index_lock:
+        hits = defaultdict(int)
+        for g in q_grams:
+            for cid in _name_index["postings"].get(g, ()):
+                hits[cid] += 1
+        scored = []
+        for cid, common in hits.items():
+            coverage = common / len(q_grams)
+            if coverage < NAME_MATCH_MIN_SCORE:
+                continue
+            # Coverage decides; similarity to the whole name breaks ties ("Ирена" → "Ирена К." before "Ирена Коганович")
+            jaccard = common / len(q_grams | _name_index["grams"][cid])
+            scored.append((cid, round(coverage * 0.8 + jaccard * 0.2, 3)))
+    scored.sort(key=lambda x: x[1], reverse=True)
+    if scored:
+        best = scored[0][1]
+        scored = [x for x in scored if x[1] >= best - NAME_MATCH_SPREAD]
+    return scored[:limit]
+
+def find_contact_by_name(name):
+    """
+    Search contact by name. Returns list of matches (best first).
+    Served from the local name index when it has a match containing every word
+    of the query and the contact cache holds the whole account; otherwise
+    amoCRM full-text search runs too and its hits come first.
+    """
+    matches = search_contact_names(name)
+    cached = get_cached_contacts([cid for cid, _ in matches]) if matches else {}
+    local = [_parse_contact_from_amocrm(cached[cid]) for cid, _ in matches if cid in cached]
+    query_words = set(normalize_name(name).split())
+    exact = any(query_words <= set(normalize_name(c["name"]).split()) for c in local)
+    if exact and get_sync_state("amocrm_contacts_backfilled"):
+        return local
+    data = amocrm_request("contacts", {"query": name, "with": "leads"})
+    contacts = (((data or {}).get("_embedded") or {}).get("contacts") or [])[:5]
+    upsert_cached_contacts(contacts)
+    found = [_parse_contact_from_amocrm(c) for c in contacts]
+    seen = {c["id"] for c in found}
+    return (found + [c for c in local if c["id"] not in seen])[:5]
+
+# ============================================================
+# PHONES — one normalizer (E.164) and the local phone → contact index
+# ============================================================
+DEFAULT_COUNTRY_CODE = "972"
+
+def normalize_phone(phone, country_code=DEFAULT_COUNTRY_CODE):
+    """
+    Phone in any common format → E.164 ("+972501234567"), or "" if it can't be one.
+    Local Israeli numbers get +972: with the trunk 0 (050…, 03…, 9–10 digits)
+    the 0 is dropped, without it (8–9 digits) the code is just prepended.
+
+    >>> normalize_phone("050-123-4567"), normalize_phone("501234567")
+    ('+972501234567', '+972501234567')
+    >>> normalize_phone("03-1234567"), normalize_phone("04-8123456")
+    ('+97231234567', '+97248123456')
+    >>> normalize_phone("31234567"), normalize_phone("+972 3 123 4567")
+    ('+97231234567', '+97231234567')
+    >>> normalize_phone("00972501234567"), normalize_phone("12345")
+    ('+972501234567', '')
+    """
+    raw = str(phone or "").strip()
+    digits = re.sub(r"[^\d]", "", raw)
+    if raw.startswith("00"):
+        digits = digits[2:]
+    elif raw.startswith("+"):
+        pass
+    elif digits.startswith("0") and 9 <= len(digits) <= 10:
+        digits = country_code + digits[1:]
+    elif 8 <= len(digits) <= 9:
+        digits = country_code + digits
+    if not 8 <= len(digits) <= 15:
+        return ""
+    return "+" + digits
 
 def find_contact_by_phone(phone):
-    """Search amoCRM contact by phone. Returns full contact dict with all custom fields."""
-    import re
-    digits = re.sub(r"[^\d]", "", phone.strip())
-
-    variants = set()
-    variants.add(digits)
-    if digits.startswith("972") and len(digits) == 12:
-        variants.add("0" + digits[3:])
-        variants.add("+" + digits)
-        variants.add(digits[3:])
-    elif digits.startswith("0") and len(digits) == 10:
-        intl = "972" + digits[1:]
-        variants.add("+" + intl)
-        variants.add(intl)
-        variants.add(digits[1:])
-    elif len(digits) == 9:
-        variants.add("0" + digits)
-        variants.add("972" + digits)
-        variants.add("+972" + digits)
-
-    for q in variants:
-        data = amocrm_request(f"contacts?query={q}&with=leads,customers")
-        if data:
-            contacts = (data.get("_embedded") or {}).get("contacts") or []
-            if contacts:
-                return _parse_contact_from_amocrm(contacts[0], phone)
-        time.sleep(0.15)
-    return None
+    """
+    Search amoCRM contact by phone. Returns full contact dict with all custom fields.
+    Answers from the local phone index; amoCRM is searched only on a miss.
+    """
+    target = normalize_phone(phone)
+    if not target:
+        return None
+    rows = db_query(
+        "SELECT c.* FROM amocrm_contact_phones p JOIN amocrm_contacts c ON c.id = p.contact_id "
+        "WHERE p.phone = ? AND c.is_deleted = 0 ORDER BY c.updated_at DESC LIMIT 1", (target,))
+    if rows:
+        return _parse_contact_from_amocrm(_contact_from_row(rows[0]), phone)
+
+    national = target[1 + len(DEFAULT_COUNTRY_CODE):] if target.startswith("+" + DEFAULT_COUNTRY_CODE) else ""
+    queries = list(dict.fromkeys(q for q in (target[1:], "0" + national if national else "", national) if q))
+    results = run_parallel({q: (lambda q=q: amocrm_request("contacts", {"query": q, "with": "leads,customers"}))
+                            for q in queries}, max_workers=AMOCRM_PAGE_WORKERS)
+    found = {}
+    for q in queries:
+        for c in ((results.get(q) or {}).get("_embedded") or {}).get("contacts") or []:
+            found.setdefault(c["id"], c)
+    if not found:
+        return None
+    upsert_cached_contacts(list(found.values()))   # next lookup is served from the index
+    for c in found.values():
+        if any(normalize_phone(v.get("value", "")) == target
+               for cf in c.get("custom_fields_values") or [] if cf.get("field_code") == "PHONE"
+               for v in cf.get("values") or []):
+            return _parse_contact_from_amocrm(c, phone)
+    return _parse_contact_from_amocrm(next(iter(found.values())), phone)
 
 def find_client(query):
     """
@@ -516,266 +2716,246 @@ def find_client(query):
             return None, []
 
 
-def get_deal_notes(deal_id):
-    """Fetch all notes/events for a deal including WhatsApp & Instagram DM messages."""
-    notes = []
-    # Fetch both deal notes and contact notes (messages often attach to contact)
-    data = amocrm_request(f"leads/{deal_id}/notes?limit=250")
-    if not data:
-        return notes
-
-    from datetime import datetime as _dt
+# ============================================================
+# amoCRM NOTES — each note stream fetched once, every note classified once
+# ============================================================
+# Note types in amoCRM integrations:
+# "common"            — manual manager note
+# "call_in/call_out"  — phone call
+# "service_message"   — system event (stage change etc.)
+# "amocrm_bot"        — chatbot message
+# "sms"               — SMS
+# Wazzup/WhatsApp integration stores as note_type "common" with direction field
+# OR as custom type "wazzup" / "whatsapp" / "instagram_direct"
+# Some integrations use params.income (true=incoming from client)
+NOTE_TYPE_LABELS = {
+    "common": "📝 Заметка",
+    "call_in": "📞 Входящий звонок",
+    "call_out": "📞 Исходящий звонок",
+    "service_message": "⚙️ Система",
+    "amocrm_bot": "🤖 Бот",
+    "sms": "💬 SMS",
+    "wazzup": "💬 WhatsApp",
+    "whatsapp": "💬 WhatsApp",
+    "instagram_direct": "📸 Instagram DM",
+    "telegram": "✈️ Telegram",
+}
 
-    # Note types in amoCRM integrations:
-    # "common"            — manual manager note
-    # "call_in/call_out"  — phone call
-    # "service_message"   — system event (stage change etc.)
-    # "amocrm_bot"        — chatbot message
-    # "sms"               — SMS
-    # Wazzup/WhatsApp integration stores as note_type "common" with direction field
-    # OR as custom type "wazzup" / "whatsapp" / "instagram_direct"
-    # Some integrations use params.income (true=incoming from client)
-
-    TYPE_LABELS = {
-        "common": "📝 Заметка",
-        "call_in": "📞 Входящий звонок",
-        "call_out": "📞 Исходящий звонок",
-        "service_message": "⚙️ Система",
-        "amocrm_bot": "🤖 Бот",
-        "sms": "💬 SMS",
-        "wazzup": "💬 WhatsApp",
-        "whatsapp": "💬 WhatsApp",
-        "instagram_direct": "📸 Instagram DM",
-        "telegram": "✈️ Telegram",
+def _note_channel(note_type):
+    nt_low = note_type.lower()
+    if "whatsapp" in nt_low or "wazzup" in nt_low:
+        return "WhatsApp"
+    if "instagram" in nt_low:
+        return "Instagram"
+    if "facebook" in nt_low or "messenger" in nt_low:
+        return "Facebook"
+    if "telegram" in nt_low:
+        return "Telegram"
+    if note_type in ("common", "amocrm_bot"):
+        return "Заметка"
+    return note_type or "chat"
+
+def _classify_note(n):
+    """Raw amoCRM note → one parsed record, or None for empty system noise."""
+    note_type = n.get("note_type", "")
+    params = n.get("params") or {}
+    # Extract text from all possible fields
+    text = params.get("text") or params.get("message") or params.get("body") or params.get("content") or ""
+    if not text and note_type == "service_message":
+        return None
+    # Direction: who wrote — client or manager
+    income = params.get("income")  # True = incoming (from client)
+    created = n.get("created_at", 0)
+    return {
+        "id": n.get("id"),
+        "type": note_type,
+        "label": NOTE_TYPE_LABELS.get(note_type, f"[{note_type}]"),
+        "channel": _note_channel(note_type),
+        "direction": "👤 Клиент" if income is True else ("💼 Менеджер" if income is False else ""),
+        "text": text,
+        "date": datetime.fromtimestamp(created).strftime("%d.%m.%Y %H:%M") if created else "",
+        "ts": created,
     }
 
-    for n in (data.get("_embedded") or {}).get("notes") or []:
-        note_type = n.get("note_type", "")
-        params = n.get("params") or {}
-        created = n.get("created_at", 0)
-        dt_str = _dt.fromtimestamp(created).strftime("%d.%m.%Y %H:%M") if created else ""
-
-        # Extract text from all possible fields
-        text = (
-            params.get("text") or
-            params.get("message") or
-            params.get("body") or
-            params.get("content") or
-            ""
-        )
-
-        # Direction: who wrote — client or manager
-        income = params.get("income")  # True = incoming (from client)
-        if income is True:
-            direction = "👤 Клиент"
-        elif income is False:
-            direction = "💼 Менеджер"
-        else:
-            direction = ""
-
-        # Skip empty service messages and stage-change noise
-        if not text and note_type == "service_message":
-            continue
-
-        if text or note_type in ("call_in", "call_out"):
-            label = TYPE_LABELS.get(note_type, f"[{note_type}]")
-            notes.append({
-                "type": note_type,
-                "label": label,
-                "direction": direction,
-                "text": text[:800] if text else "(звонок)",
-                "date": dt_str,
-                "raw": n,
-            })
-
-    # Sort chronologically
-    notes.sort(key=lambda x: x["raw"].get("created_at", 0))
-    # Remove raw field before returning
-    for n in notes:
-        n.pop("raw", None)
-
-    return notes
-
-def get_contact_notes(contact_id):
-    """Fetch notes attached directly to the contact (WhatsApp/Instagram often here)."""
-    notes = []
-    data = amocrm_request(f"contacts/{contact_id}/notes?limit=250")
-    if not data:
-        return notes
+AMOCRM_NOTES_SYNC_TTL = 120   # a stream synced this recently is served from the archive as is
 
-    from datetime import datetime as _dt
-    TYPE_LABELS = {
-        "common": "📝 Заметка", "call_in": "📞 Входящий", "call_out": "📞 Исходящий",
-        "service_message": "⚙️ Система", "amocrm_bot": "🤖 Бот", "sms": "💬 SMS",
-        "wazzup": "💬 WhatsApp", "whatsapp": "💬 WhatsApp",
-        "instagram_direct": "📸 Instagram DM", "telegram": "✈️ Telegram",
-    }
+def _sync_note_stream(entity, entity_id):
+    """Pull notes changed since the stream's watermark (all of them the first time) into amocrm_notes."""
+    state = db_query("SELECT watermark_ts, synced_at FROM amocrm_note_streams WHERE entity = ? AND entity_id = ?",
+                     (entity, entity_id))
+    watermark, synced_at = (state[0]["watermark_ts"], state[0]["synced_at"]) if state else (0, 0)
+    if time.time() - synced_at < AMOCRM_NOTES_SYNC_TTL:
+        return
+    params = {"order[updated_at]": "asc"}
+    if watermark:
+        params["filter[updated_at][from]"] = max(watermark - AMOCRM_SYNC_OVERLAP, 0)
+    notes, status = amocrm_paginate(f"{entity}/{entity_id}/notes", params, "notes")
+    if notes:
+        watermark = max(watermark, max(n.get("updated_at") or n.get("created_at") or 0 for n in notes))
+    with _db_lock:
+        conn = get_db()
+        conn.executemany(
+            "INSERT OR REPLACE INTO amocrm_notes (id, entity, entity_id, note_type, params, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(n["id"], entity, entity_id, n.get("note_type", ""), json.dumps(n.get("params") or {}, ensure_ascii=False),
+              n.get("created_at", 0) or 0, n.get("updated_at", 0) or 0) for n in notes if n.get("id")])
+        # Oldest changes come first, so a partial run may still advance the watermark
+        conn.execute("INSERT OR REPLACE INTO amocrm_note_streams (entity, entity_id, watermark_ts, synced_at) "
+                     "VALUES (?, ?, ?, ?)",
+                     (entity, entity_id, watermark, int(time.time()) if status["complete"] else synced_at))
+        conn.commit()
+
+def _archived_notes(entity, entity_id):
+    rows = db_query("SELECT * FROM amocrm_notes WHERE entity = ? AND entity_id = ? ORDER BY created_at, id",
+                    (entity, entity_id))
+    records = [_classify_note({"id": r["id"], "note_type": r["note_type"], "created_at": r["created_at"],
+                               "params": json.loads(r["params"] or "{}")}) for r in rows]
+    return [r for r in records if r]
+
+def fetch_note_streams(streams):
+    """
+    streams: [("leads", id) | ("contacts", id), ...] → {stream: [records, oldest first]}.
+    Each stream is synced into the local notes archive once (only notes newer
+    than its watermark are requested), all in parallel under the rate limiter;
+    the records then come from the archive with the full history.
+    """
+    streams = list(dict.fromkeys(streams))
 
-    for n in (data.get("_embedded") or {}).get("notes") or []:
-        note_type = n.get("note_type", "")
-        params = n.get("params") or {}
-        created = n.get("created_at", 0)
-        dt_str = _dt.fromtimestamp(created).strftime("%d.%m.%Y %H:%M") if created else ""
-        text = params.get("text") or params.get("message") or params.get("body") or params.get("content") or ""
-        income = params.get("income")
-        direction = "👤 Клиент" if income is True else ("💼 Менеджер" if income is False else "")
-        if not text and note_type == "service_message":
-            continue
-        if text or note_type in ("call_in", "call_out"):
-            label = TYPE_LABELS.get(note_type, f"[{note_type}]")
-            notes.append({
-                "type": note_type, "label": label, "direction": direction,
-                "text": text[:800] if text else "(звонок)", "date": dt_str,
-                "ts": created,
-            })
+    def _stream(stream):
+        try:
+            _sync_note_stream(*stream)
+        except Exception as e:
+            print(f"amoCRM notes sync error {stream}: {e}")
+        return _archived_notes(*stream)
 
-    notes.sort(key=lambda x: x.get("ts", 0))
-    for n in notes: n.pop("ts", None)
-    return notes
-    """Fetch full deal details including custom fields."""
-    data = amocrm_request(f"leads/{deal_id}?with=contacts,tags")
-    if not data:
+    if not streams:
         return {}
-    cf = {}
-    for field in (data.get("custom_fields_values") or []):
-        fname = field.get("field_name", "")
-        vals = field.get("values") or []
-        if fname and vals:
-            val = vals[0].get("value")
-            if isinstance(val, int) and val > 1000000000:
-                from datetime import datetime as _dt
-                try: val = _dt.fromtimestamp(val).strftime("%d.%m.%Y %H:%M")
-                except: pass
-            cf[fname] = val
-    tags = [t.get("name","") for t in (data.get("_embedded") or {}).get("tags") or []]
+    with ThreadPoolExecutor(max_workers=AMOCRM_PAGE_WORKERS) as ex:
+        return dict(zip(streams, ex.map(_stream, streams)))
+
+def _notes_view(records):
+    """Per-deal / per-contact list: text notes and calls, chronological."""
+    return [{
+        "type": r["type"], "label": r["label"], "direction": r["direction"],
+        "text": r["text"][:800] if r["text"] else "(звонок)", "date": r["date"],
+    } for r in records if r["text"] or r["type"] in ("call_in", "call_out")]
+
+# Known channel IDs from amoCRM Wazzup settings — used when the channel list can't be loaded
+WAZZUP_FALLBACK_CHANNELS = [
+    {"channelId": "972534488475", "channelType": "whatsapp"},
+    {"channelId": "972533222611", "channelType": "whatsapp"},
+]
+
+_wazzup_session = requests.Session()
+_wazzup_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=WAZZUP_MAX_CONCURRENCY))
+_wazzup_channels = {"channels": [], "loaded_at": 0}
+_wazzup_channels_lock = threading.Lock()
+
+def _wazzup_headers():
+    return {"Authorization": f"Bearer {WAZZUP_API_KEY}", "Content-Type": "application/json"}
+
+def get_wazzup_channels():
+    """Channel list kept for WAZZUP_CHANNELS_TTL; the known IDs are retried after 5 minutes."""
+    with _wazzup_channels_lock:
+        if time.time() - _wazzup_channels["loaded_at"] < WAZZUP_CHANNELS_TTL:
+            return _wazzup_channels["channels"]
+        channels = []
+        try:
+            ch_resp = _wazzup_session.get(f"{WAZZUP_API_URL}/channels", headers=_wazzup_headers(), timeout=WAZZUP_TIMEOUT)
+            print(f"Wazzup channels status: {ch_resp.status_code}")
+            if ch_resp.status_code == 200:
+                channels_raw = ch_resp.json()
+                channels = channels_raw if isinstance(channels_raw, list) else (channels_raw.get("channels") or [])
+        except Exception as e:
+            print(f"Wazzup channels error: {e}")
+        loaded_at = time.time()
+        if not channels:
+            print("Wazzup: using hardcoded channel IDs")
+            channels = WAZZUP_FALLBACK_CHANNELS
+            loaded_at -= WAZZUP_CHANNELS_TTL - 300
+        _wazzup_channels.update({"channels": channels, "loaded_at": loaded_at})
+        return channels
+
+def _parse_wazzup_message(m, ch_label, chat_id):
+    ts = m.get("timestamp") or m.get("dateTime") or 0
+    # dateTime may be ISO string
+    if isinstance(ts, str):
+        try:
+            ts = int(datetime.fromisoformat(ts.replace("Z","+00:00")).timestamp())
+        except: ts = 0
+    text = m.get("text") or m.get("body") or m.get("caption") or ""
+    if not text:
+        return None
+    incoming = m.get("incoming")
+    if incoming is None:
+        status = m.get("status","")
+        incoming = status in ("inbound", "received", "") or m.get("isEcho") == False
     return {
-        "id": deal_id,
-        "name": data.get("name",""),
-        "price": data.get("price", 0),
-        "status_id": data.get("status_id"),
-        "pipeline_id": data.get("pipeline_id"),
-        "created_at": data.get("created_at", 0),
-        "closed_at": data.get("closed_at", 0),
-        "custom_fields": cf,
-        "tags": tags,
+        "date": datetime.fromtimestamp(ts).strftime("%d.%m.%Y %H:%M") if ts else "",
+        "direction": "👤 Клиент" if incoming else "💼 Менеджер",
+        "channel": ch_label, "text": text[:600], "ts": ts,
+        "chat_id": chat_id, "message_id": m.get("messageId") or m.get("id"),
     }
 
 def get_wazzup_messages(phones, limit=100):
     """
     Fetch chat messages from Wazzup24 API by phone numbers.
-    Uses known channel IDs directly.
+    Every distinct (channel, chatId) pair is asked once, all concurrently;
+    as soon as one returns history the calls still queued are cancelled.
     """
     if not WAZZUP_API_KEY:
         print("Wazzup API key not configured (WAZZUP_API_KEY)")
         return []
 
-    from datetime import datetime as _dt
-    messages = []
-
-    headers = {
-        "Authorization": f"Bearer {WAZZUP_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
-    # Normalize phones
-    search_phones = set()
-    for p in phones:
-        digits = re.sub(r"[^\d]", "", p)
-        search_phones.add(digits)
-        if digits.startswith("972") and len(digits) == 12:
-            search_phones.add("0" + digits[3:])
-            search_phones.add(digits[3:])  # 9-digit
-        elif digits.startswith("0") and len(digits) == 10:
-            search_phones.add("972" + digits[1:])
-            search_phones.add(digits[1:])  # 9-digit
-
-    print(f"Wazzup: searching for phones {list(search_phones)[:4]}")
-
-    # Get channels — try API first, fallback to known IDs
-    try:
-        ch_resp = requests.get("https://api.wazzup24.com/v3/channels",
-                               headers=headers, timeout=15)
-        print(f"Wazzup channels status: {ch_resp.status_code}")
-        if ch_resp.status_code == 200:
-            channels_raw = ch_resp.json()
-            channels = channels_raw if isinstance(channels_raw, list) else (channels_raw.get("channels") or [])
-        else:
-            channels = []
-    except Exception as e:
-        print(f"Wazzup channels error: {e}")
-        channels = []
-
-    # If API didn't return channels — use known channel IDs from amoCRM Wazzup settings
-    if not channels:
-        print("Wazzup: using hardcoded channel IDs")
-        channels = [
-            {"channelId": "972534488475", "channelType": "whatsapp"},
-            {"channelId": "972533222611", "channelType": "whatsapp"},
-        ]
-
-    print(f"Wazzup: trying {len(channels)} channels")
+    # One chatId per distinct phone (Wazzup uses international digits, no "+")
+    chat_ids = list(dict.fromkeys(normalize_phone(p)[1:] for p in phones if normalize_phone(p)))
+    print(f"Wazzup: searching for phones {chat_ids[:4]}")
 
-    for ch in channels:
+    pairs = {}
+    for ch in get_wazzup_channels():
         channel_id = ch.get("channelId") or ch.get("id")
         channel_type = (ch.get("channelType") or ch.get("transport") or "whatsapp").lower()
         if not channel_id:
             continue
-
         ch_label = "Instagram" if "instagram" in channel_type else \
                    "Telegram" if "telegram" in channel_type else "WhatsApp"
+        for chat_id in chat_ids:
+            pairs.setdefault((channel_id, chat_id), ch_label)
+    print(f"Wazzup: trying {len(pairs)} channel/chat pairs")
+
+    def _fetch(channel_id, chat_id, ch_label):
+        msg_resp = _wazzup_session.get(
+            f"{WAZZUP_API_URL}/messages", headers=_wazzup_headers(),
+            params={"channelId": channel_id, "chatId": chat_id, "count": limit}, timeout=WAZZUP_TIMEOUT)
+        print(f"Wazzup messages [{ch_label}/{chat_id[-6:]}] ch={channel_id[-6:]}: {msg_resp.status_code}")
+        if msg_resp.status_code != 200:
+            return []
+        msgs_raw = msg_resp.json()
+        msgs = msgs_raw if isinstance(msgs_raw, list) else (msgs_raw.get("messages") or [])
+        return [p for p in (_parse_wazzup_message(m, ch_label, chat_id) for m in msgs) if p]
 
-        for phone in list(search_phones):
-            phone_digits = re.sub(r"[^\d]", "", phone)
-            # Use international format for chatId
-            if phone_digits.startswith("972"):
-                chat_id = phone_digits
-            elif phone_digits.startswith("0") and len(phone_digits) == 10:
-                chat_id = "972" + phone_digits[1:]
-            elif len(phone_digits) == 9:
-                chat_id = "972" + phone_digits
-            else:
-                chat_id = phone_digits
-
-            try:
-                msg_resp = requests.get(
-                    "https://api.wazzup24.com/v3/messages",
-                    headers=headers,
-                    params={"channelId": channel_id, "chatId": chat_id, "count": limit},
-                    timeout=15,
-                )
-                print(f"Wazzup messages [{ch_label}/{chat_id[-6:]}] ch={channel_id[-6:]}: {msg_resp.status_code}")
-                if msg_resp.status_code != 200:
-                    continue
-
-                msgs_raw = msg_resp.json()
-                msgs = msgs_raw if isinstance(msgs_raw, list) else (msgs_raw.get("messages") or [])
-                print(f"  -> {len(msgs)} messages!")
-
-                for m in msgs:
-                    ts = m.get("timestamp") or m.get("dateTime") or 0
-                    # dateTime may be ISO string
-                    if isinstance(ts, str):
-                        try:
-                            from datetime import datetime as _dt2
-                            ts = int(_dt2.fromisoformat(ts.replace("Z","+00:00")).timestamp())
-                        except: ts = 0
-                    text = m.get("text") or m.get("body") or m.get("caption") or ""
-                    incoming = m.get("incoming")
-                    if incoming is None:
-                        status = m.get("status","")
-                        incoming = status in ("inbound", "received", "") or m.get("isEcho") == False
-                    direction = "👤 Клиент" if incoming else "💼 Менеджер"
-                    if text:
-                        dt_str = _dt.fromtimestamp(ts).strftime("%d.%m.%Y %H:%M") if ts else ""
-                        messages.append({
-                            "date": dt_str, "direction": direction,
-                            "channel": ch_label, "text": text[:600], "ts": ts,
-                        })
-                if msgs:
-                    break  # found for this phone, no need to try other formats
+    messages = []
+    if pairs:
+        ex = ThreadPoolExecutor(max_workers=min(WAZZUP_MAX_CONCURRENCY, len(pairs)))
+        futures = [ex.submit(_fetch, channel_id, chat_id, ch_label) for (channel_id, chat_id), ch_label in pairs.items()]
+        try:
+            for fut in as_completed(futures):
+                try:
+                    messages.extend(fut.result())
+                except Exception as e:
+                    print(f"Wazzup messages error: {e}")
+                if messages:
+                    # History found — keep what else has already finished, drop the rest
+                    for other in futures:
+                        if other is not fut and other.done() and not other.cancelled() and not other.exception():
+                            messages.extend(other.result())
+                    break
+        finally:
+            ex.shutdown(wait=False, cancel_futures=True)
+        print(f"  -> {len(messages)} messages")
 
-            except Exception as e:
-                print(f"Wazzup messages error: {e}")
+    # Archive what came back; older history the API no longer returns is served from the archive
+    messages = archive_wazzup_messages(messages, chat_ids)
 
     # Deduplicate and sort
     seen = set()
@@ -790,14 +2970,30 @@ def get_wazzup_messages(phones, limit=100):
     print(f"Wazzup total: {len(unique)} messages")
     return unique
 
-
-def get_contact_conversations(contact_id, lead_ids=None, all_phones=None):
+def archive_wazzup_messages(messages, chat_ids):
+    """Store fetched Wazzup messages; returns the full archived history of chat_ids."""
+    rows = []
+    for m in messages:
+        key = m.pop("message_id", None) or hashlib.sha1(
+            f"{m['chat_id']}:{m['ts']}:{m['text'][:40]}".encode()).hexdigest()
+        rows.append((str(key), m.pop("chat_id"), m["channel"], m["direction"], m["text"], m["ts"]))
+    if rows:
+        db_executemany("INSERT OR REPLACE INTO wazzup_messages (message_key, chat_id, channel, direction, text, ts) "
+                       "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    if not chat_ids:
+        return messages
+    marks = ",".join("?" * len(chat_ids))
+    archived = db_query(f"SELECT * FROM wazzup_messages WHERE chat_id IN ({marks}) ORDER BY ts", tuple(chat_ids))
+    return [{"date": datetime.fromtimestamp(r["ts"]).strftime("%d.%m.%Y %H:%M") if r["ts"] else "",
+             "direction": r["direction"], "channel": r["channel"], "text": r["text"], "ts": r["ts"]}
+            for r in archived]
+
+
+def get_contact_conversations(contact_id, lead_ids=None, all_phones=None, note_streams=None):
     """
     Fetch chat messages. Tries Wazzup API first, then amoCRM notes as fallback.
+    note_streams: records already loaded by fetch_note_streams (reused, not refetched).
     """
-    from datetime import datetime as _dt
-    messages = []
-
     # 1. Wazzup API (WhatsApp / Instagram / Telegram)
     if WAZZUP_API_KEY and all_phones:
         wz_msgs = get_wazzup_messages(all_phones)
@@ -805,86 +3001,26 @@ def get_contact_conversations(contact_id, lead_ids=None, all_phones=None):
             return wz_msgs
         # Wazzup key present but returned nothing — still try amoCRM notes below
 
-    # 2. amoCRM contact notes (fallback — works when no Wazzup key)
-    notes_data = amocrm_request(f"contacts/{contact_id}/notes?limit=500")
-    if notes_data:
-        for n in (notes_data.get("_embedded") or {}).get("notes") or []:
-            nt = n.get("note_type", "")
-            params = n.get("params") or {}
-            created = n.get("created_at", 0)
-            text = (params.get("text") or params.get("message") or
-                    params.get("body") or params.get("content") or "")
-            income = params.get("income")
-            direction = "👤 Клиент" if income is True else ("💼 Менеджер" if income is False else "")
-            nt_low = nt.lower()
-            if "whatsapp" in nt_low or "wazzup" in nt_low:
-                channel = "WhatsApp"
-            elif "instagram" in nt_low:
-                channel = "Instagram"
-            elif "facebook" in nt_low or "messenger" in nt_low:
-                channel = "Facebook"
-            elif "telegram" in nt_low:
-                channel = "Telegram"
-            elif nt in ("common", "amocrm_bot"):
-                channel = "Заметка"
-            else:
-                channel = nt or "chat"
-            if text and created:
-                messages.append({
-                    "date": _dt.fromtimestamp(created).strftime("%d.%m.%Y %H:%M"),
-                    "direction": direction,
-                    "channel": channel,
-                    "text": text[:600],
-                    "ts": created,
-                })
-
-    # 3. Lead notes for last 3 deals only
-    if lead_ids:
-        for lid in lead_ids[:3]:
-            ln_data = amocrm_request(f"leads/{lid}/notes?limit=100")
-            if ln_data:
-                for n in (ln_data.get("_embedded") or {}).get("notes") or []:
-                    nt = n.get("note_type", "")
-                    params = n.get("params") or {}
-                    created = n.get("created_at", 0)
-                    text = (params.get("text") or params.get("message") or
-                            params.get("body") or params.get("content") or "")
-                    income = params.get("income")
-                    direction = "👤 Клиент" if income is True else ("💼 Менеджер" if income is False else "")
-                    nt_low = nt.lower()
-                    if "whatsapp" in nt_low or "wazzup" in nt_low: channel = "WhatsApp"
-                    elif "instagram" in nt_low: channel = "Instagram"
-                    elif "facebook" in nt_low: channel = "Facebook"
-                    elif nt in ("common",): channel = "Заметка"
-                    else: channel = nt or "chat"
-                    if text and created:
-                        messages.append({
-                            "date": _dt.fromtimestamp(created).strftime("%d.%m.%Y %H:%M"),
-                            "direction": direction,
-                            "channel": channel,
-                            "text": text[:600],
-                            "ts": created,
-                        })
+    # 2. amoCRM contact notes + lead notes for last 3 deals only
+    wanted = [("contacts", contact_id)] + [("leads", lid) for lid in (lead_ids or [])[:3]]
+    streams = dict(note_streams or {})
+    missing = [st for st in wanted if st not in streams]
+    if missing:
+        streams.update(fetch_note_streams(missing))
 
     # Deduplicate and sort
     seen = set()
     unique = []
-    for m in messages:
-        key = (m.get("ts"), m.get("text","")[:40])
-        if key not in seen:
+    for r in sorted((r for st in wanted for r in streams.get(st, [])), key=lambda r: r["ts"]):
+        key = (r["ts"], r["text"][:40])
+        if r["text"] and r["ts"] and key not in seen:
             seen.add(key)
-            unique.append(m)
-    unique.sort(key=lambda x: x.get("ts", 0))
-    for m in unique: m.pop("ts", None)
+            unique.append({"date": r["date"], "direction": r["direction"], "channel": r["channel"], "text": r["text"][:600]})
     print(f"Conversations for contact {contact_id}: {len(unique)} messages total")
     return unique
 
 
-def get_deal_full(deal_id):
-    """Fetch full deal details including custom fields."""
-    data = amocrm_request(f"leads/{deal_id}?with=contacts,tags")
-    if not data:
-        return {}
+def _normalize_deal_full(data):
     cf = {}
     for field in (data.get("custom_fields_values") or []):
         fname = field.get("field_name", "")
@@ -898,7 +3034,7 @@ def get_deal_full(deal_id):
             cf[fname] = val
     tags = [t.get("name","") for t in (data.get("_embedded") or {}).get("tags") or []]
     return {
-        "id": deal_id,
+        "id": data.get("id"),
         "name": data.get("name", ""),
         "price": data.get("price", 0),
         "status_id": data.get("status_id"),
@@ -909,6 +3045,14 @@ def get_deal_full(deal_id):
         "tags": tags,
     }
 
+def get_deals_full(deal_ids):
+    """Full deal details (custom fields, tags) via bulk leads?filter[id][]= batches, input order kept."""
+    ids = list(dict.fromkeys(deal_ids))
+    if not ids:
+        return []
+    by_id = {d["id"]: _normalize_deal_full(d) for d in amocrm_fetch_by_ids("leads", ids, "contacts,tags")}
+    return [by_id[i] for i in ids if i in by_id]
+
 def analyze_client(query):
     """Full client profile by phone OR name."""
     contact, candidates = find_client(query)
@@ -940,22 +3084,16 @@ def analyze_client(query):
     print(f"Client {contact['name']} has {len(lead_ids)} deals total")
 
     # Fetch ALL deals for stats (up to 200)
-    deals_summary = []
-    for lid in lead_ids[:200]:
-        d = get_deal_full(lid)
-        if d:
-            deals_summary.append(d)
-        time.sleep(0.1)
+    deals_summary = get_deals_full(lead_ids[:200])
 
     # Sort newest first
     deals_summary.sort(key=lambda x: x.get("created_at", 0), reverse=True)
 
-    # Detailed notes only for 10 most recent deals
-    deals_detailed = []
-    for d in deals_summary[:10]:
-        notes = get_deal_notes(d["id"])
-        d["notes"] = notes
-        deals_detailed.append(d)
+    # Detailed notes only for 10 most recent deals; the contact's own notes come in the same parallel fetch
+    deals_detailed = deals_summary[:10]
+    note_streams = fetch_note_streams([("contacts", contact["id"])] + [("leads", d["id"]) for d in deals_detailed])
+    for d in deals_detailed:
+        d["notes"] = _notes_view(note_streams.get(("leads", d["id"]), []))
 
     # Full history summary by year/month for prompt
     from collections import defaultdict as _dd
@@ -1003,7 +3141,8 @@ def analyze_client(query):
     contact_notes = get_contact_conversations(
         contact["id"],
         lead_ids=[d["id"] for d in deals_detailed[:5]],
-        all_phones=contact.get("all_phones", [])
+        all_phones=contact.get("all_phones", []),
+        note_streams=note_streams,
     )
 
     return {
@@ -1212,6 +3351,44 @@ def get_deal_branch(tags):
                 return b
     return "Не указан"
 
+# ============================================================
+# TAG REGISTRY — interned tag strings, derived attributes cached per tag set
+# ============================================================
+TAG_REGISTRY_MAX_SETS = 50000   # distinct tag sets are few; this only guards against runaway growth
+
+_tag_strings = {}
+_tagset_attrs = {}
+
+def intern_tags(tags):
+    return tuple(_tag_strings.setdefault(t, t) for t in tags)
+
+def tag_attributes(tags):
+    """
+    {"tags", "fb_tag", "campaign", "branch"} for a tag list — parsed once per
+    distinct tag set, then a dictionary hit. The returned dicts are shared:
+    read them, don't modify them.
+    """
+    key = tags if isinstance(tags, tuple) else tuple(tags)
+    attrs = _tagset_attrs.get(key)
+    if attrs is None:
+        if len(_tagset_attrs) >= TAG_REGISTRY_MAX_SETS:
+            _tagset_attrs.clear()
+        key = intern_tags(key)
+        attrs = {
+            "tags": key,
+            "fb_tag": extract_fb_tag(key),
+            "campaign": parse_campaign_tag(key),
+            "branch": get_deal_branch(key),
+        }
+        _tagset_attrs[key] = attrs
+    return attrs
+
+def deal_tag_attributes(deal):
+    return tag_attributes(get_deal_tags(deal))
+
+def get_tag_registry_stats():
+    return {"tags": len(_tag_strings), "tag_sets": len(_tagset_attrs)}
+
 def should_filter_branch(branch, since=None, until=None):
     if branch in ["Ашдод", "Раат"]:
         return False
@@ -1229,212 +3406,258 @@ def should_filter_branch(branch, since=None, until=None):
         return True
     return False
 
+# ============================================================
+# DEAL FRAME — deals as columns with integer codes, for single-pass rollups
+# ============================================================
+OUTCOME_OPEN, OUTCOME_WON, OUTCOME_LOST = 0, 1, 2
+
+def _encode(values):
+    """Values → (codes, uniques) in first-seen order; None gets code -1."""
+    index, codes = {}, []
+    for v in values:
+        if v is None:
+            codes.append(-1)
+        else:
+            codes.append(index.setdefault(v, len(index)))
+    return codes, list(index)
+
+def _finish_frame(frame, stages, dims):
+    status_ids = dims["stage"]
+    frame["outcome"] = [OUTCOME_WON if sid in stages["won_ids"] else
+                        OUTCOME_LOST if sid in stages["lost_ids"] else OUTCOME_OPEN for sid in status_ids]
+    for column, values in dims.items():
+        frame[column], frame[column + "_values"] = _encode(values)
+    return frame
+
+def build_deal_frame(deals, stages):
+    """
+    Columnar view of deals: plain lists, one per field, plus integer-coded
+    dimensions (branch, fb tag, campaign tag, stage, pipeline). Tag-derived
+    values come from the tag registry; rollups then work on codes only.
+    Every row is one deal (weight 1).
+    """
+    attrs = [deal_tag_attributes(d) for d in deals]
+    prices = [d.get("price", 0) or 0 for d in deals]
+    frame = {
+        "n": len(deals),
+        "id": [d.get("id") for d in deals],
+        "name": [d.get("name", "") for d in deals],
+        "weight": [1] * len(deals),
+        "price": prices,
+        "priced": [1 if p > 0 else 0 for p in prices],
+        "min_price": prices,
+        "max_price": prices,
+        "created_at": [d.get("created_at", 0) for d in deals],
+        "closed_at": [d.get("closed_at", 0) for d in deals],
+        "contact_ids": [[c["id"] for c in (d.get("_embedded") or {}).get("contacts") or []] for d in deals],
+    }
+    return _finish_frame(frame, stages, {
+        "branch": [a["branch"] for a in attrs],
+        "fb_tag": [a["fb_tag"] or None for a in attrs],
+        "campaign_tag": [a["campaign"]["raw"] if a["campaign"] else None for a in attrs],
+        "stage": [d.get("status_id", 0) for d in deals],
+        "pipeline": [d.get("pipeline_id", 0) for d in deals],
+    })
+
+def build_rollup_frame(rows, stages):
+    """
+    The same frame built from get_crm_rollup rows: each row stands for
+    `deals` deals, with their summed price and won-price bounds. There are
+    no per-deal columns (id, name, dates, contacts).
+    """
+    frame = {
+        "n": len(rows),
+        "weight": [r["deals"] for r in rows],
+        "price": [r["price_sum"] or 0 for r in rows],
+        "priced": [r["priced"] or 0 for r in rows],
+        "min_price": [r["min_price"] or 0 for r in rows],
+        "max_price": [r["max_price"] or 0 for r in rows],
+    }
+    return _finish_frame(frame, stages, {
+        "branch": [r["branch"] for r in rows],
+        "fb_tag": [r["fb_tag"] or None for r in rows],
+        "campaign_tag": [r["campaign_tag"] or None for r in rows],
+        "stage": [r["status_id"] for r in rows],
+        "pipeline": [r["pipeline_id"] for r in rows],
+    })
+
+def _group_totals(size):
+    return {"deals": [0] * size, "revenue": [0] * size, "with_revenue": [0] * size, "won": [0] * size, "lost": [0] * size}
+
+def rollup_deal_frame(frame, rows):
+    """
+    One pass over the selected rows, accumulating bincount-style per code for
+    every dimension at once. Returns {dimension: totals} where totals are lists
+    indexed by code, plus the (campaign, stage) / (pipeline, stage) counts and
+    per-campaign min/max won price.
+    """
+    dims = ("branch", "fb_tag", "campaign_tag", "stage", "pipeline")
+    totals = {dim: _group_totals(len(frame[dim + "_values"])) for dim in dims}
+    campaign_stage = defaultdict(int)
+    pipeline_stage = defaultdict(int)
+    campaign_min, campaign_max = {}, {}
+    columns = [(totals[dim], frame[dim]) for dim in dims]
+    weight_col, price_col, priced_col, outcome_col = frame["weight"], frame["price"], frame["priced"], frame["outcome"]
+    stage_col, campaign_col, pipeline_col = frame["stage"], frame["campaign_tag"], frame["pipeline"]
+
+    for i in rows:
+        weight, price, priced, outcome = weight_col[i], price_col[i], priced_col[i], outcome_col[i]
+        for t, codes in columns:
+            code = codes[i]
+            if code < 0:
+                continue
+            t["deals"][code] += weight
+            if outcome == OUTCOME_WON:
+                t["won"][code] += weight
+                t["revenue"][code] += price
+                t["with_revenue"][code] += priced
+            elif outcome == OUTCOME_LOST:
+                t["lost"][code] += weight
+        pipeline_stage[(pipeline_col[i], stage_col[i])] += weight
+        camp = campaign_col[i]
+        if camp >= 0:
+            campaign_stage[(camp, stage_col[i])] += weight
+            if outcome == OUTCOME_WON and priced:
+                low, high = frame["min_price"][i], frame["max_price"][i]
+                campaign_min[camp] = min(campaign_min.get(camp, low), low)
+                campaign_max[camp] = max(campaign_max.get(camp, high), high)
+    totals.update(campaign_stage=campaign_stage, pipeline_stage=pipeline_stage,
+                  campaign_min=campaign_min, campaign_max=campaign_max)
+    return totals
+
 # ============================================================
 # DEEP ANALYTICS
 # ============================================================
-def analyze_crm_data(since=None, until=None):
+@request_cached
+def analyze_crm_data(since=None, until=None, details=False):
+    """
+    CRM summary for deals created in the period. Totals come from the daily
+    rollup; details=True reads the deals themselves and adds the per-deal
+    "_deal_details" list (campaign funnels).
+    """
     print("Fetching amoCRM data...")
 
-    date_filter = None
-    if since and until:
-        date_filter = {
-            "from": int(datetime.strptime(since, "%Y-%m-%d").timestamp()),
-            "to": int(datetime.strptime(until, "%Y-%m-%d").timestamp()) + 86400,
-        }
-
-    deals = get_all_amocrm_deals(date_filter=date_filter)
-    pipelines = get_amocrm_pipelines()
+    if details:
+        date_filter = None
+        if since and until:
+            date_filter = {
+                "from": int(datetime.strptime(since, "%Y-%m-%d").timestamp()),
+                "to": int(datetime.strptime(until, "%Y-%m-%d").timestamp()) + 86400,
+            }
+        records, deals_status = get_crm_deals(date_filter)
+        status_ids = {d.get("status_id") for d in records}
+    else:
+        records, deals_status = get_crm_rollup(since, until)
+        status_ids = {r["status_id"] for r in records}
 
-    if not deals:
+    if not records:
         return {"error": "Не удалось загрузить сделки из amoCRM"}
 
-    stage_map = {}
-    closed_won_ids = set()
-    closed_lost_ids = set()
-
-    # === iStudio amoCRM stage IDs (verified via /debug) ===
-    # Рабочая воронка (5896168):
-    #   52041937 = "Пробная процедура выполнена" ← ВЫРУЧКА
-    #   143      = "Закрыто и не реализовано"    ← ПОТЕРЯ
-    # Постоянные клиенты (8703286):
-    #   70503946 = "Процедура выполнена"          ← ВЫРУЧКА
-    #   143      = "Закрыто и не реализовано"    ← ПОТЕРЯ
-    # Архив (5891302) / Догрев (5896195) — не считаем
-    KNOWN_WON_IDS  = {52041937, 70503946}
-    KNOWN_LOST_IDS = {143}
+    stages = get_stage_registry(status_ids=status_ids)
+    pipelines = stages["pipelines"]
+    stage_map = stages["stage_map"]
+
+    frame = build_deal_frame(records, stages) if details else build_rollup_frame(records, stages)
+    # The branch filter depends only on the branch, so it is decided once per branch code
+    keep_branch = [should_filter_branch(b, since, until) for b in frame["branch_values"]]
+    rows = [i for i, b in enumerate(frame["branch"]) if keep_branch[b]]
+    totals = rollup_deal_frame(frame, rows)
+    total_deals = sum(totals["branch"]["deals"])
+    loaded_deals = sum(frame["weight"])
+    filtered_out = loaded_deals - total_deals
+
+    def _groups(dim, keys=("deals", "revenue", "with_revenue", "won", "lost")):
+        t = totals[dim]
+        return {value: {k: t[k][code] for k in keys}
+                for code, value in enumerate(frame[dim + "_values"]) if t["deals"][code]}
+
+    stage_ids = frame["stage_values"]
+    by_branch = _groups("branch", ("deals", "revenue", "won", "lost"))
+    by_source = _groups("fb_tag")
+    by_stage = {}
+    for code, sid in enumerate(stage_ids):
+        if totals["stage"]["deals"][code]:
+            name = stage_map.get(sid, f"Этап {sid}")
+            by_stage[name] = by_stage.get(name, 0) + totals["stage"]["deals"][code]
 
-    for p in pipelines:
-        for s in p["stages"]:
-            stage_map[s["id"]] = s["name"]
-            sid = s["id"]
-            name_lower = s["name"].lower()
-
-            if sid in KNOWN_WON_IDS:
-                closed_won_ids.add(sid)
-                print(f"WON: '{s['name']}' id={sid}")
-            elif sid in KNOWN_LOST_IDS:
-                closed_lost_ids.add(sid)
-                print(f"LOST: '{s['name']}' id={sid}")
-            else:
-                # Fallback for any future new stages
-                if "не реализовано" in name_lower or "закрыто и не" in name_lower:
-                    closed_lost_ids.add(sid)
-                    print(f"LOST (name): '{s['name']}' id={sid}")
-                elif name_lower in ("процедура выполнена", "пробная процедура выполнена",
-                                    "успешно реализовано"):
-                    closed_won_ids.add(sid)
-                    print(f"WON (name): '{s['name']}' id={sid}")
-                else:
-                    print(f"OTHER: '{s['name']}' id={sid}")
-
-    print(f"WON ids={closed_won_ids} | LOST ids={closed_lost_ids}")
-
-    total_revenue = 0
-    total_deals = 0
-    filtered_out = 0
-    deals_with_revenue = 0
-    by_source = {}
     by_campaign_tag = {}
-    by_stage = {}
-    by_branch = {}
-    won_deals = []
-    lost_deals = 0
-    all_deal_details = []
-
-    for deal in deals:
-        price = deal.get("price", 0) or 0
-        tags = get_deal_tags(deal)
-        fb_tag = extract_fb_tag(tags)
-        campaign_info = parse_campaign_tag(tags)
-        branch = get_deal_branch(tags)
-        stage_id = deal.get("status_id", 0)
-        stage_name = stage_map.get(stage_id, f"Этап {stage_id}")
-        created_at = deal.get("created_at", 0)
-        closed_at = deal.get("closed_at", 0)
-
-        if not should_filter_branch(branch, since, until):
-            filtered_out += 1
+    for code, tag_key in enumerate(frame["campaign_tag_values"]):
+        g = {k: totals["campaign_tag"][k][code] for k in ("deals", "revenue", "with_revenue", "won", "lost")}
+        if not g["deals"]:
             continue
-
-        total_deals += 1
-        # Revenue only from successfully closed deals
-        if stage_id in closed_won_ids:
-            total_revenue += price
-            if price > 0:
-                deals_with_revenue += 1
-
-        by_stage[stage_name] = by_stage.get(stage_name, 0) + 1
-
-        if branch not in by_branch:
-            by_branch[branch] = {"deals": 0, "revenue": 0, "won": 0, "lost": 0}
-        by_branch[branch]["deals"] += 1
-
-        if stage_id in closed_won_ids:
-            by_branch[branch]["won"] += 1
-            by_branch[branch]["revenue"] += price
-            won_deals.append(deal)
-        elif stage_id in closed_lost_ids:
-            by_branch[branch]["lost"] += 1
-            lost_deals += 1
-
-        if fb_tag:
-            if fb_tag not in by_source:
-                by_source[fb_tag] = {"deals": 0, "revenue": 0, "with_revenue": 0, "won": 0, "lost": 0}
-            by_source[fb_tag]["deals"] += 1
-            if stage_id in closed_won_ids:
-                by_source[fb_tag]["won"] += 1
-                by_source[fb_tag]["revenue"] += price
-                if price > 0:
-                    by_source[fb_tag]["with_revenue"] += 1
-            elif stage_id in closed_lost_ids:
-                by_source[fb_tag]["lost"] += 1
-
-        if campaign_info:
-            tag_key = campaign_info["raw"]
-            if tag_key not in by_campaign_tag:
-                by_campaign_tag[tag_key] = {"deals": 0, "revenue": 0, "with_revenue": 0, "won": 0, "lost": 0, "prices": [], "stages": {}}
-            by_campaign_tag[tag_key]["deals"] += 1
-            by_campaign_tag[tag_key]["stages"][stage_name] = by_campaign_tag[tag_key]["stages"].get(stage_name, 0) + 1
-            if stage_id in closed_won_ids:
-                by_campaign_tag[tag_key]["won"] += 1
-                by_campaign_tag[tag_key]["revenue"] += price
-                if price > 0:
-                    by_campaign_tag[tag_key]["with_revenue"] += 1
-                    by_campaign_tag[tag_key]["prices"].append(price)
-            elif stage_id in closed_lost_ids:
-                by_campaign_tag[tag_key]["lost"] += 1
-
-        deal_info = {
-            "id": deal.get("id"),
-            "name": deal.get("name", ""),
-            "price": price,
-            "stage": stage_name,
-            "fb_tag": fb_tag,
-            "campaign_tag": campaign_info["raw"] if campaign_info else None,
-            "branch": branch,
-            "created_at": created_at,
-            "closed_at": closed_at,
-            "is_won": stage_id in closed_won_ids,
-            "is_lost": stage_id in closed_lost_ids,
-            "contact_ids": [c["id"] for c in (deal.get("_embedded") or {}).get("contacts") or []],
-        }
-        all_deal_details.append(deal_info)
-
-    for tag_key in by_campaign_tag:
-        prices = by_campaign_tag[tag_key].pop("prices", [])
-        if prices:
-            by_campaign_tag[tag_key]["avg_deal"] = round(sum(prices) / len(prices), 0)
-            by_campaign_tag[tag_key]["max_deal"] = max(prices)
-            by_campaign_tag[tag_key]["min_deal"] = min(prices)
+        g["stages"] = {}
+        by_campaign_tag[tag_key] = g
+    for (camp, stage_code), count in totals["campaign_stage"].items():
+        stage_name = stage_map.get(stage_ids[stage_code], f"Этап {stage_ids[stage_code]}")
+        stages_count = by_campaign_tag[frame["campaign_tag_values"][camp]]["stages"]
+        stages_count[stage_name] = stages_count.get(stage_name, 0) + count
+    for code, tag_key in enumerate(frame["campaign_tag_values"]):
+        g = by_campaign_tag.get(tag_key)
+        if g is None:
+            continue
+        if g["with_revenue"]:
+            g["avg_deal"] = round(g["revenue"] / g["with_revenue"], 0)
+            g["max_deal"] = totals["campaign_max"][code]
+            g["min_deal"] = totals["campaign_min"][code]
         else:
-            by_campaign_tag[tag_key]["avg_deal"] = 0
+            g["avg_deal"] = 0
+
+    outcome = frame["outcome"]
+    total_revenue = sum(totals["branch"]["revenue"])
+    deals_with_revenue = sum(totals["branch"]["with_revenue"])
+    won_count = sum(totals["branch"]["won"])
+    lost_deals = sum(totals["branch"]["lost"])
+
+    all_deal_details = [{
+        "id": frame["id"][i],
+        "name": frame["name"][i],
+        "price": frame["price"][i],
+        "stage": stage_map.get(stage_ids[frame["stage"][i]], f"Этап {stage_ids[frame['stage'][i]]}"),
+        "fb_tag": frame["fb_tag_values"][frame["fb_tag"][i]] if frame["fb_tag"][i] >= 0 else None,
+        "campaign_tag": frame["campaign_tag_values"][frame["campaign_tag"][i]] if frame["campaign_tag"][i] >= 0 else None,
+        "branch": frame["branch_values"][frame["branch"][i]],
+        "created_at": frame["created_at"][i],
+        "closed_at": frame["closed_at"][i],
+        "is_won": outcome[i] == OUTCOME_WON,
+        "is_lost": outcome[i] == OUTCOME_LOST,
+        "contact_ids": frame["contact_ids"][i],
+    } for i in rows] if details else None
 
     PIPELINE_WORKING = 5896168
     PIPELINE_PERMANENT = 8703286
 
-    working_funnel = {"total": 0, "stages": {}, "revenue": 0, "won": 0, "lost": 0}
-    permanent_funnel = {"total": 0, "stages": {}, "revenue": 0, "won": 0, "lost": 0}
-
-    for deal in deals:
-        tags = get_deal_tags(deal)
-        branch = get_deal_branch(tags)
-        if not should_filter_branch(branch, since, until):
-            continue
-        pid = deal.get("pipeline_id", 0)
-        price = deal.get("price", 0) or 0
-        stage_id = deal.get("status_id", 0)
-        stage_name = stage_map.get(stage_id, f"Stage {stage_id}")
-
-        if pid == PIPELINE_WORKING:
-            working_funnel["total"] += 1
-            working_funnel["stages"][stage_name] = working_funnel["stages"].get(stage_name, 0) + 1
-            if stage_id in closed_won_ids:
-                working_funnel["won"] += 1
-                working_funnel["revenue"] += price
-            elif stage_id in closed_lost_ids:
-                working_funnel["lost"] += 1
-        elif pid == PIPELINE_PERMANENT:
-            permanent_funnel["total"] += 1
-            permanent_funnel["stages"][stage_name] = permanent_funnel["stages"].get(stage_name, 0) + 1
-            if stage_id in closed_won_ids:
-                permanent_funnel["won"] += 1
-                permanent_funnel["revenue"] += price
-            elif stage_id in closed_lost_ids:
-                permanent_funnel["lost"] += 1
+    pipeline_codes = {pid: code for code, pid in enumerate(frame["pipeline_values"])}
+
+    def _funnel(pid):
+        funnel = {"total": 0, "stages": {}, "revenue": 0, "won": 0, "lost": 0}
+        code = pipeline_codes.get(pid)
+        if code is None:
+            return funnel
+        t = totals["pipeline"]
+        funnel.update(total=t["deals"][code], revenue=t["revenue"][code], won=t["won"][code], lost=t["lost"][code])
+        # Funnel stages in pipeline order rather than first-seen order
+        ranked = sorted(((stages["stage_rank"].get((pid, stage_ids[sc]), len(stage_map)), stage_map.get(stage_ids[sc], f"Stage {stage_ids[sc]}"), count)
+                         for (pc, sc), count in totals["pipeline_stage"].items() if pc == code), key=lambda x: x[0])
+        for _, name, count in ranked:
+            funnel["stages"][name] = funnel["stages"].get(name, 0) + count
+        return funnel
+
+    working_funnel = _funnel(PIPELINE_WORKING)
+    permanent_funnel = _funnel(PIPELINE_PERMANENT)
 
     sorted_campaigns = sorted(by_campaign_tag.items(), key=lambda x: x[1]["revenue"], reverse=True)
-    print(f"REVENUE DEBUG: total_deals={total_deals}, won={len(won_deals)}, total_revenue={total_revenue}, filtered_out={filtered_out}")
+    print(f"REVENUE DEBUG: total_deals={total_deals}, won={won_count}, total_revenue={total_revenue}, filtered_out={filtered_out}")
 
-    return {
+    result = {
         "total_deals": total_deals,
         "filtered_out_deals": filtered_out,
         "branch_filter": "Только Ришон" if since and until and (datetime.strptime(until, "%Y-%m-%d").date() - datetime.strptime(since, "%Y-%m-%d").date()).days <= 365 else "Все кроме Ашдода",
         "total_revenue": total_revenue,
         "deals_with_revenue": deals_with_revenue,
         "avg_deal": round(total_revenue / deals_with_revenue, 2) if deals_with_revenue > 0 else 0,
-        "won_deals": len(won_deals),
+        "won_deals": won_count,
         "lost_deals": lost_deals,
-        "conversion_rate": round(len(won_deals) / total_deals * 100, 1) if total_deals > 0 else 0,
+        "conversion_rate": round(won_count / total_deals * 100, 1) if total_deals > 0 else 0,
         "by_stage": by_stage,
         "working_funnel": working_funnel,
         "permanent_funnel": permanent_funnel,
@@ -1443,12 +3666,29 @@ def analyze_crm_data(since=None, until=None):
         "by_campaign_tag": dict(sorted_campaigns[:15]),
         "pipelines": [{"name": p["name"], "stages": [s["name"] for s in p["stages"]]} for p in pipelines],
         "period": {"since": since, "until": until} if since else None,
-        "_deal_details": all_deal_details,
     }
+    if details:
+        result["_deal_details"] = all_deal_details
+    if not deals_status["complete"] and deals_status.get("delta"):
+        # The mirror is complete; only changes since the last successful sync are missing
+        result["crm_data_incomplete"] = {
+            "note": "Последние изменения из amoCRM не подтянулись — цифры актуальны на момент прошлой синхронизации",
+        }
+    elif not deals_status["complete"]:
+        if deals_status["truncated_at"]:
+            result["truncated_at"] = deals_status["truncated_at"]
+        result["crm_data_incomplete"] = {
+            "loaded_deals": loaded_deals,
+            "note": (f"Загружено только первые {deals_status['truncated_at']} сделок (лимит страниц) — цифры неполные"
+                     if deals_status["truncated_at"] else
+                     "amoCRM не отдал часть сделок (лимиты/ошибки API) — цифры неполные"),
+        }
+    return result
 
+@request_cached
 def analyze_campaign_funnel(campaign_tag, since=None, until=None):
     """Detailed stage-by-stage funnel for a specific campaign tag."""
-    crm = analyze_crm_data(since, until)
+    crm = analyze_crm_data(since, until, details=True)
     if "error" in crm:
         return crm
 
@@ -1584,19 +3824,15 @@ def format_campaign_funnel(data):
 
     return "\n".join(lines)
 
+@request_cached
 def analyze_golden_clients(since=None, until=None):
     crm = analyze_crm_data(since, until)
     if "error" in crm:
         return crm
 
-    deal_details = crm.pop("_deal_details", [])
-
-    contact_deals = defaultdict(list)
-    for d in deal_details:
-        for cid in (d.get("contact_ids") or []):
-            contact_deals[cid].append(d)
+    clients, _ = get_contact_ltv(since, until)
 
-    all_contact_ids = list(contact_deals.keys())
+    all_contact_ids = list(clients)
     print(f"Fetching {len(all_contact_ids)} contacts from amoCRM...")
     contact_info_map = get_amocrm_contacts(all_contact_ids)
 
@@ -1604,20 +3840,15 @@ def analyze_golden_clients(since=None, until=None):
     repeat_clients = []
     one_time_clients = []
 
-    for cid, deals in contact_deals.items():
-        total_spent = sum(d["price"] for d in deals)
-        deal_count = len(deals)
-        won_count = sum(1 for d in deals if d["is_won"])
-        campaigns = list(set(d["campaign_tag"] for d in deals if d["campaign_tag"]))
-        fb_tags = list(set(d["fb_tag"] for d in deals if d["fb_tag"]))
-        branches = list(set(d["branch"] for d in deals))
-        deal_names = list(set(d["name"] for d in deals if d["name"]))
-
-        dates = [d["created_at"] for d in deals if d["created_at"]]
-        if len(dates) >= 2:
-            lifetime_days = (max(dates) - min(dates)) / 86400
-        else:
-            lifetime_days = 0
+    for cid, agg in clients.items():
+        total_spent = agg["total_spent"]
+        deal_count = agg["deals"]
+        won_count = agg["won"]
+        campaigns = agg["campaigns"]
+        fb_tags = agg["fb_tags"]
+        branches = agg["branches"]
+        deal_names = agg["names"]
+        lifetime_days = (agg["last_deal"] - agg["first_deal"]) / 86400
 
         cinfo = contact_info_map.get(cid, {})
         client_name = cinfo.get("name", "Без имени")
@@ -1651,8 +3882,8 @@ def analyze_golden_clients(since=None, until=None):
             "branches": branches,
             "procedures": deal_names[:5],
             "lifetime_days": round(lifetime_days),
-            "first_deal": min(dates) if dates else 0,
-            "last_deal": max(dates) if dates else 0,
+            "first_deal": agg["first_deal"],
+            "last_deal": agg["last_deal"],
             "avg_deal_value": round(total_spent / deal_count, 0) if deal_count > 0 else 0,
         }
 
@@ -1712,23 +3943,17 @@ def analyze_golden_clients(since=None, until=None):
 
     sorted_quality = sorted(campaign_quality_clean.items(), key=lambda x: x[1]["quality_score"], reverse=True)
 
-    fb_to_meta_name = {}
     try:
-        all_meta_campaigns = get_all_campaigns("name,id")
-        for mc in all_meta_campaigns:
-            meta_id = mc.get("id", "")
-            meta_name = mc.get("name", "")
-            fb_key = f"fb{meta_id}"
-            fb_to_meta_name[fb_key] = meta_name
-    except:
-        pass
+        get_campaign_catalog()
+    except Exception as e:
+        print(f"Meta campaign catalog error: {e}")
 
     fb_tag_quality_clean = {}
     for ft, data in fb_tag_quality.items():
         total_clients = data["golden"] + data["repeat"] + data["one_time"]
         if total_clients < 1:
             continue
-        meta_name = fb_to_meta_name.get(ft, "")
+        meta_name = campaign_name_by_fb_tag(ft)
         fb_tag_quality_clean[ft] = {
             "fb_tag": ft,
             "meta_campaign_name": meta_name if meta_name else "Не найдена в Meta (возможно удалена)",
@@ -1784,8 +4009,9 @@ def analyze_golden_clients(since=None, until=None):
         "total_golden_revenue": sum(c["total_spent"] for c in golden_clients),
         "total_repeat_revenue": sum(c["total_spent"] for c in repeat_clients),
         "total_onetime_revenue": sum(c["total_spent"] for c in one_time_clients),
-        "total_clients": len(contact_deals),
+        "total_clients": len(clients),
         "period": {"since": since, "until": until} if since else None,
+        **({"crm_data_incomplete": crm["crm_data_incomplete"]} if "crm_data_incomplete" in crm else {}),
         "crm_summary": {
             "total_deals": crm["total_deals"],
             "total_revenue": crm["total_revenue"],
@@ -1795,28 +4021,31 @@ def analyze_golden_clients(since=None, until=None):
         },
     }
 
+@request_cached
 def analyze_campaign_roi(since=None, until=None):
     if not since or not until:
         since, until = get_date_range("all")
-    insights = get_account_insights(since, until)
-    meta_campaigns = enrich_insights(insights)
 
-    crm = analyze_crm_data(since, until)
+    def _leads():
+        try:
+            return count_meta_leads(since, until)
+        except Exception as e:
+            print(f"Meta leads fetch error: {e}")
+            return {"total": 0, "by_campaign": {}}
+
+    fetched = run_parallel({
+        "insights": lambda: get_account_insights(since, until),
+        "crm": lambda: analyze_crm_data(since, until),
+        "leads": _leads,
+    })
+    meta_campaigns = enrich_insights(fetched["insights"])
+
+    crm = fetched["crm"]
     if "error" in crm:
         return crm
-    crm.pop("_deal_details", None)
 
-    meta_leads = []
-    try:
-        meta_leads = get_meta_leads(since, until)
-    except Exception as e:
-        print(f"Meta leads fetch error: {e}")
-
-    meta_leads_by_campaign = defaultdict(int)
-    for lead in meta_leads:
-        camp_name = lead.get("campaign_name", "")
-        if camp_name:
-            meta_leads_by_campaign[camp_name] += 1
+    meta_leads = fetched["leads"]
+    meta_leads_by_campaign = meta_leads["by_campaign"]
 
     roi_data = []
     for mc in meta_campaigns:
@@ -1862,21 +4091,30 @@ def analyze_campaign_roi(since=None, until=None):
     total_spend = sum(r["spend"] for r in roi_data)
     total_revenue = crm["total_revenue"]
 
-    return {
+    result = {
         "roi_campaigns": roi_data[:20],
         "total_spend": total_spend,
         "total_revenue": total_revenue,
         "total_deals": crm["total_deals"],
         "total_roi": round((total_revenue - total_spend) / total_spend * 100, 1) if total_spend > 0 else 0,
-        "meta_leads_total": len(meta_leads),
+        "meta_leads_total": meta_leads["total"],
         "period": {"since": since, "until": until},
     }
-
+    gaps = meta_data_gaps(since, until)
+    if gaps:
+        result["meta_data_incomplete"] = gaps
+        if gaps.get("still_loading"):
+            # Spend for part of the period is still being fetched — ROI over partial spend would be wrong
+            result.update(total_roi=None, roi_campaigns=[], roi_unavailable=gaps["note"])
+    if "crm_data_incomplete" in crm:
+        result["crm_data_incomplete"] = crm["crm_data_incomplete"]
+    return result
+
+@request_cached
 def analyze_funnel(since=None, until=None):
     crm = analyze_crm_data(since, until)
     if "error" in crm:
         return crm
-    crm.pop("_deal_details", None)
     return {
         "total_deals": crm["total_deals"],
         "won_deals": crm["won_deals"],
@@ -1886,13 +4124,14 @@ def analyze_funnel(since=None, until=None):
         "pipelines": crm["pipelines"],
         "by_branch": crm["by_branch"],
         "period": {"since": since, "until": until} if since else None,
+        **({"crm_data_incomplete": crm["crm_data_incomplete"]} if "crm_data_incomplete" in crm else {}),
     }
 
+@request_cached
 def analyze_ltv(since=None, until=None):
     crm = analyze_crm_data(since, until)
     if "error" in crm:
         return crm
-    crm.pop("_deal_details", None)
     return {
         "total_deals": crm["total_deals"],
         "total_revenue": crm["total_revenue"],
@@ -1905,30 +4144,37 @@ def analyze_ltv(since=None, until=None):
         "by_branch": crm["by_branch"],
         "by_source": crm["by_source"],
         "period": {"since": since, "until": until} if since else None,
+        **({"crm_data_incomplete": crm["crm_data_incomplete"]} if "crm_data_incomplete" in crm else {}),
     }
 
+@request_cached
 def full_analytics(since=None, until=None):
     if not since or not until:
         since, until = get_date_range("month")
 
-    insights = get_account_insights(since, until)
-    meta_campaigns = enrich_insights(insights)
-
-    meta_leads = []
-    try:
-        meta_leads = get_meta_leads(since, until)
-    except:
-        pass
-
-    crm = analyze_crm_data(since, until)
+    def _leads():
+        try:
+            return count_meta_leads(since, until)
+        except Exception as e:
+            print(f"Meta leads fetch error: {e}")
+            return {"total": 0, "by_campaign": {}}
+
+    fetched = run_parallel({
+        "insights": lambda: get_account_insights(since, until),
+        "leads": _leads,
+        "crm": lambda: analyze_crm_data(since, until),
+    })
+    meta_campaigns = enrich_insights(fetched["insights"])
+    meta_leads = fetched["leads"]
+
+    crm = fetched["crm"]
     if "error" in crm:
         return crm
-    crm.pop("_deal_details", None)
 
     total_meta_spend = sum(c["spend"] for c in meta_campaigns)
     total_meta_leads = sum(c.get("total_leads", 0) for c in meta_campaigns)
 
-    return {
+    result = {
         "period": {"since": since, "until": until},
         "meta_ads": {
             "total_spend": total_meta_spend,
@@ -1948,10 +4194,8 @@ def full_analytics(since=None, until=None):
             ],
         },
         "leads_center": {
-            "total_leads": len(meta_leads),
-            "by_campaign": dict(sorted(
-                {lead.get("campaign_name", "?"): 0 for lead in meta_leads}.items()
-            )),
+            "total_leads": meta_leads["total"],
+            "by_campaign": dict(sorted(meta_leads["by_campaign"].items())),
         },
         "crm": {
             "total_deals": crm["total_deals"],
@@ -1967,10 +4211,19 @@ def full_analytics(since=None, until=None):
         },
         "overall_roi": round((crm["total_revenue"] - total_meta_spend) / total_meta_spend * 100, 1) if total_meta_spend > 0 else 0,
     }
+    gaps = meta_data_gaps(since, until)
+    if gaps:
+        result["meta_data_incomplete"] = gaps
+        if gaps.get("still_loading"):
+            result.update(overall_roi=None, roi_unavailable=gaps["note"])
+    if "crm_data_incomplete" in crm:
+        result["crm_data_incomplete"] = crm["crm_data_incomplete"]
+    return result
 
 # ============================================================
 # COMPARISON DATA FOR DASHBOARD
 # ============================================================
+@request_cached
 def fetch_comparison_data(since, until):
     """
     Fetch analytics for the PREVIOUS period (same length) to compute deltas.
@@ -1995,7 +4248,6 @@ def fetch_comparison_data(since, until):
 
     try:
         prev_crm = analyze_crm_data(prev_since, prev_until)
-        prev_crm.pop("_deal_details", None)
         if "error" in prev_crm:
             prev_crm = {}
     except Exception as e:
@@ -2073,8 +4325,11 @@ def format_report(data):
     p_name = period_names.get(data["period"], data["period"])
     since, until = data["since"], data["until"]
 
+    gaps = data.get("meta_data_incomplete")
+    gaps_note = f"\n⚠️ {gaps['note']}" if gaps else ""
+
     if not campaigns:
-        return f"📊 За {p_name} ({since}) расхода не было."
+        return f"📊 За {p_name} ({since}) расхода не было." + gaps_note
 
     header = f"📊 Сводка за {p_name} ({since}"
     if since != until:
@@ -2127,6 +4382,7 @@ def format_report(data):
         footer += "🎯 Итого:\n"
         for label, count in totals.items():
             footer += f"   {label}: {count}\n"
+    footer += gaps_note
     footer += "\n⚠️ Claude временно недоступен — анализ без ИИ"
     return header + body + footer
 
@@ -2380,12 +4636,14 @@ def generate_response(user_text, data, data_type="spend"):
 # ============================================================
 # MORNING & WEEKLY REPORTS
 # ============================================================
+@request_scoped
 def send_morning_report():
     data = fetch_spend_data("yesterday")
     report = f"🌅 Доброе утро!\n\n" + format_report(data)
     report += f"\n\n💡 Напиши 'покажи за неделю' или 'золотые клиенты' для глубокой аналитики"
     safe_send(MY_CHAT_ID, report)
 
+@request_scoped
 def send_weekly_crm_report():
     try:
         safe_send(MY_CHAT_ID, "📊 Еженедельный отчёт...\n⏳ Собираю данные из Meta Ads и amoCRM")
@@ -2449,9 +4707,9 @@ def fetch_spend_data(period, since=None, until=None):
         y_spend = sum(c["spend"] for c in y_campaigns)
 
         try:
-            all_camps = get_all_campaigns("name,effective_status")
-            active_names = [c.get("name", "—") for c in all_camps if c.get("effective_status") == "ACTIVE"]
-            paused_count = len([c for c in all_camps if c.get("effective_status") == "PAUSED"])
+            status = campaign_status_summary()
+            active_names = status["active_names"]
+            paused_count = status["paused_count"]
         except:
             active_names = []
             paused_count = 0
@@ -2469,13 +4727,14 @@ def fetch_spend_data(period, since=None, until=None):
             "paused_count": paused_count,
         }
 
-    return {"period": period, "since": since, "until": until, "campaigns": campaigns, "total_spend": round(total_spend, 2)}
+    result = {"period": period, "since": since, "until": until, "campaigns": campaigns, "total_spend": round(total_spend, 2)}
+    gaps = meta_data_gaps(since, until)
+    if gaps:
+        result["meta_data_incomplete"] = gaps
+    return result
 
 def fetch_all_campaigns_list():
-    camps = get_all_campaigns()
-    active = [c.get("name", "—") for c in camps if c.get("effective_status") == "ACTIVE"]
-    paused = len([c for c in camps if c.get("effective_status") == "PAUSED"])
-    return {"total": len(camps), "active_names": active, "active_count": len(active), "paused_count": paused}
+    return campaign_status_summary()
 
 # ============================================================
 # DASHBOARD PNG GENERATOR (with period comparison)
@@ -3092,6 +5351,7 @@ def cmd_start(message):
     )
 
 @bot.message_handler(commands=["today"])
+@request_scoped
 def cmd_today(message):
     if message.chat.id != MY_CHAT_ID:
         return
@@ -3100,6 +5360,7 @@ def cmd_today(message):
     safe_send(MY_CHAT_ID, generate_response("расходы сегодня", data, "spend"))
 
 @bot.message_handler(commands=["yesterday"])
+@request_scoped
 def cmd_yesterday(message):
     if message.chat.id != MY_CHAT_ID:
         return
@@ -3108,6 +5369,7 @@ def cmd_yesterday(message):
     safe_send(MY_CHAT_ID, generate_response("расходы вчера", data, "spend"))
 
 @bot.message_handler(commands=["week"])
+@request_scoped
 def cmd_week(message):
     if message.chat.id != MY_CHAT_ID:
         return
@@ -3116,6 +5378,7 @@ def cmd_week(message):
     safe_send(MY_CHAT_ID, generate_response("расходы за неделю", data, "spend"))
 
 @bot.message_handler(commands=["month"])
+@request_scoped
 def cmd_month(message):
     if message.chat.id != MY_CHAT_ID:
         return
@@ -3128,6 +5391,7 @@ def cmd_campaigns(message):
     if message.chat.id != MY_CHAT_ID:
         return
     safe_send(MY_CHAT_ID, "⏳")
+    refresh_campaign_catalog()  # explicit list request — show statuses as of now
     safe_send(MY_CHAT_ID, generate_response("список кампаний", fetch_all_campaigns_list()))
 
 @bot.message_handler(commands=["alerts"])
@@ -3144,21 +5408,23 @@ def cmd_alerts(message):
     safe_send(MY_CHAT_ID, "🔔 Проблемы и алерты:\n\n" + "\n".join(alerts) if alerts else "✅ Всё в порядке, проблем нет.")
 
 @bot.message_handler(commands=["report"])
+@request_scoped
 def cmd_report(message):
     if message.chat.id != MY_CHAT_ID:
         return
     send_morning_report()
 
 @bot.message_handler(commands=["crm"])
+@request_scoped
 def cmd_crm(message):
     if message.chat.id != MY_CHAT_ID:
         return
     safe_send(MY_CHAT_ID, "📊 Загружаю данные из amoCRM...\n⏳")
     data = analyze_crm_data()
-    data.pop("_deal_details", None)
     safe_send(MY_CHAT_ID, generate_response("сводка по продажам CRM", data, "crm"))
 
 @bot.message_handler(commands=["roi"])
+@request_scoped
 def cmd_roi(message):
     if message.chat.id != MY_CHAT_ID:
         return
@@ -3167,6 +5433,7 @@ def cmd_roi(message):
     safe_send(MY_CHAT_ID, generate_response("окупаемость рекламы", data, "roi"))
 
 @bot.message_handler(commands=["ltv"])
+@request_scoped
 def cmd_ltv(message):
     if message.chat.id != MY_CHAT_ID:
         return
@@ -3175,6 +5442,7 @@ def cmd_ltv(message):
     safe_send(MY_CHAT_ID, generate_response("ценность клиентов по источникам", data, "ltv"))
 
 @bot.message_handler(commands=["funnel"])
+@request_scoped
 def cmd_funnel(message):
     if message.chat.id != MY_CHAT_ID:
         return
@@ -3183,6 +5451,7 @@ def cmd_funnel(message):
     safe_send(MY_CHAT_ID, generate_response("воронка продаж", data, "funnel"))
 
 @bot.message_handler(commands=["golden"])
+@request_scoped
 def cmd_golden(message):
     if message.chat.id != MY_CHAT_ID:
         return
@@ -3191,20 +5460,25 @@ def cmd_golden(message):
     safe_send(MY_CHAT_ID, generate_response("золотые и постоянные клиенты", data, "golden"))
 
 @bot.message_handler(commands=["full"])
+@request_scoped
 def cmd_full(message):
     if message.chat.id != MY_CHAT_ID:
         return
     safe_send(MY_CHAT_ID, "📊 Собираю полный отчёт: Meta Ads + Центр лидов + amoCRM...\n⏳")
-    data = full_analytics()
+    since, until = get_date_range("month")
+    prefetch_meta(since, until)
+    data = full_analytics(since, until)
     safe_send(MY_CHAT_ID, generate_response("полный отчёт по рекламе и продажам", data, "full_report"))
 
 @bot.message_handler(commands=["dashboard"])
+@request_scoped
 def cmd_dashboard(message):
     if message.chat.id != MY_CHAT_ID:
         return
     safe_send(MY_CHAT_ID, "📊 Генерирую дашборд с динамикой...\n⏳ Загружаю оба периода параллельно")
     try:
         since, until = get_date_range("month")
+        prefetch_meta(since, until, compare=True)
         results = {}
 
         def _fetch_current():
@@ -3219,8 +5493,8 @@ def cmd_dashboard(message):
             except Exception as e:
                 results["prev"] = {}
 
-        t1 = threading.Thread(target=_fetch_current)
-        t2 = threading.Thread(target=_fetch_prev)
+        t1 = threading.Thread(target=in_request_scope(_fetch_current))
+        t2 = threading.Thread(target=in_request_scope(_fetch_prev))
         t1.start()
         t2.start()
         t1.join(timeout=180)
@@ -3249,7 +5523,7 @@ def cmd_debug(message):
 
     report = "🔧 ДИАГНОСТИКА amoCRM\n\n"
 
-    pipelines = get_amocrm_pipelines()
+    pipelines = refresh_stage_registry()["pipelines"]
     report += "📋 ВОРОНКИ:\n"
     for p in pipelines:
         report += f"\n  Воронка: {p['name']} (ID: {p['id']})\n"
@@ -3263,7 +5537,8 @@ def cmd_debug(message):
         all_pipelines_found = set()
 
         for i, deal in enumerate(deals[:20]):
-            tags = get_deal_tags(deal)
+            tag_info = deal_tag_attributes(deal)
+            tags = list(tag_info["tags"])
             all_tags_found.update(tags)
             pipeline_id = deal.get("pipeline_id", 0)
             all_pipelines_found.add(pipeline_id)
@@ -3284,12 +5559,32 @@ def cmd_debug(message):
             report += f"  Pipeline ID: {pipeline_id}\n"
             report += f"  Status ID: {deal.get('status_id', 0)}\n"
             report += f"  Теги: {tags if tags else 'НЕТ'}\n"
+            report += (f"  Разбор тегов: fb={tag_info['fb_tag'] or '—'} | филиал={tag_info['branch']} | "
+                       f"кампания={tag_info['campaign']['raw'] if tag_info['campaign'] else '—'}\n")
             if custom_fields:
                 report += f"  Доп.поля: {json.dumps(custom_fields, ensure_ascii=False)}\n"
 
         report += f"\n\n📈 СВОДКА:\n"
         report += f"  Все найденные теги: {sorted(all_tags_found) if all_tags_found else 'НЕТ ТЕГОВ'}\n"
         report += f"  Pipeline IDs: {sorted(all_pipelines_found)}\n"
+        reg = get_tag_registry_stats()
+        report += f"  Реестр тегов: {reg['tags']} тегов, {reg['tag_sets']} наборов\n"
+
+    lim = get_amocrm_limiter_stats()
+    report += (
+        f"\n\n⏱ ЛИМИТЕР amoCRM ({lim['rate_per_sec']:g} запр/с):\n"
+        f"  Запросов: {lim['acquired']} | ждали: {lim['waited']} "
+        f"(всего {lim['wait_total']}с, ср. {lim['wait_avg']}с, макс. {lim['wait_max']}с)\n"
+        f"  Очередь сейчас: {lim['queue_depth']} | макс.: {lim['queue_max']} | 429 от amoCRM: {lim['throttled']}\n"
+    )
+
+    if _webhook_state["running"]:
+        wh = _webhook_state
+        last = datetime.fromtimestamp(wh["last_at"]).strftime("%H:%M:%S") if wh["last_at"] else "—"
+        report += (
+            f"\n🔔 ВЕБХУКИ amoCRM: получено {wh['received']} | применено {wh['applied']} | "
+            f"повторы {wh['duplicates']} | устаревшие {wh['stale']} | отклонено {wh['rejected']} | последний {last}\n"
+        )
 
     safe_send(MY_CHAT_ID, report)
 
@@ -3327,6 +5622,7 @@ def transcribe_voice(message):
             pass
         return None
 
+@request_scoped
 def _handle_show(show, since, until, user_text, period=None, intent=None):
     """Shared handler logic for both text and voice."""
     if show == "campaign_funnel":
@@ -3427,7 +5723,6 @@ def _handle_show(show, since, until, user_text, period=None, intent=None):
         safe_send(MY_CHAT_ID, format_client_profile(data))
     elif show == "crm":
         data = analyze_crm_data(since, until)
-        data.pop("_deal_details", None)
         safe_send(MY_CHAT_ID, generate_response(user_text, data, "crm"))
     elif show == "roi":
         data = analyze_campaign_roi(since, until)
@@ -3451,10 +5746,12 @@ def _handle_show(show, since, until, user_text, period=None, intent=None):
         safe_send(MY_CHAT_ID, generate_response(user_text, data, "golden"))
     elif show == "full_report":
         safe_send(MY_CHAT_ID, "📊 Собираю полный отчёт...\n⏳")
+        prefetch_meta(since, until)
         data = full_analytics(since, until)
         safe_send(MY_CHAT_ID, generate_response(user_text, data, "full_report"))
     elif show in ("budget_advice", "dead_campaigns"):
         safe_send(MY_CHAT_ID, "💰 Анализирую данные...\n⏳")
+        prefetch_meta(since, until, campaigns=True)
         golden_data = analyze_golden_clients(since, until)
         meta_data = {}
         try:
@@ -3472,7 +5769,6 @@ def _handle_show(show, since, until, user_text, period=None, intent=None):
     elif show == "branch_compare":
         safe_send(MY_CHAT_ID, "🏢 Сравниваю филиалы...\n⏳")
         data = analyze_crm_data(since, until)
-        data.pop("_deal_details", None)
         safe_send(MY_CHAT_ID, generate_response(user_text, data, "branch_compare"))
     elif show == "dashboard":
         safe_send(MY_CHAT_ID, "📊 Генерирую дашборд с динамикой...\n⏳ Загружаю оба периода параллельно")
@@ -3483,7 +5779,8 @@ def _handle_show(show, since, until, user_text, period=None, intent=None):
         }
         plabel = period_names.get(period, f"{since} — {until}") if period else f"{since} — {until}"
 
-        # Fetch current and previous period IN PARALLEL
+        # One Graph batch for both periods, then fetch current and previous IN PARALLEL
+        prefetch_meta(since, until, compare=True)
         results = {}
         def _fetch_current():
             try:
@@ -3499,8 +5796,8 @@ def _handle_show(show, since, until, user_text, period=None, intent=None):
                 print(f"Dashboard prev fetch error: {e}")
                 results["prev"] = {}
 
-        t1 = threading.Thread(target=_fetch_current)
-        t2 = threading.Thread(target=_fetch_prev)
+        t1 = threading.Thread(target=in_request_scope(_fetch_current))
+        t2 = threading.Thread(target=in_request_scope(_fetch_prev))
         t1.start()
         t2.start()
         t1.join(timeout=180)
@@ -3594,6 +5891,8 @@ def run_scheduler():
     schedule.every().day.at(f"{utc_hour:02d}:00").do(send_morning_report)
     utc_hour_weekly = 9 - ISRAEL_UTC_OFFSET
     schedule.every().sunday.at(f"{utc_hour_weekly:02d}:00").do(send_weekly_crm_report)
+    if AMOCRM_TOKEN:
+        schedule.every(AMOCRM_RECONCILE_HOURS).hours.do(reconcile_amocrm_deals)
     while True:
         schedule.run_pending()
         time.sleep(30)
@@ -3602,11 +5901,21 @@ def run_scheduler():
 # MAIN
 # ============================================================
 if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--replay-webhooks":
+        # python agent.py --replay-webhooks recorded.txt [http://host:port/amocrm/webhook]
+        replay_amocrm_webhooks(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+        sys.exit(0)
+
     print("🚀 Bot starting...")
     print(f"📅 Israel time: {get_israel_now().strftime('%Y-%m-%d %H:%M')}")
     print(f"📊 amoCRM: {'✅ configured' if AMOCRM_TOKEN else '❌ no token'}")
     print(f"📊 Meta: {'✅ configured' if META_ACCESS_TOKEN else '❌ no token'}")
     print(f"🎙 Voice: {'✅ OpenAI Whisper' if OPENAI_API_KEY else '❌ no key'}")
+    if start_amocrm_webhook_server():
+        print(f"🔔 amoCRM webhooks: port {AMOCRM_WEBHOOK_PORT}")
+    if AMOCRM_TOKEN:
+        # Phone lookups need every contact indexed; runs once, in the background
+        threading.Thread(target=backfill_amocrm_contacts, daemon=True).start()
 
     bot.delete_webhook(drop_pending_updates=True)
     time.sleep(1)